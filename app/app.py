@@ -1,24 +1,55 @@
 import os
 from databricks import sql
 from databricks.sdk.core import Config
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
 import numpy as np
-from shapely.geometry import Polygon
 import dash
-from dash import dcc, html, Input, Output, State, callback_context, no_update
+from dash import dcc, html, Input, Output, State, callback_context, no_update, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import plotly.express as px
 import dash_bootstrap_components as dbc
 import dash_ag_grid as dag
 from databricks.sdk.core import Config
 import dash_leaflet as dl
 from dash.dependencies import Input, Output
-from dash_extensions.javascript import arrow_function
+from dash_extensions.javascript import arrow_function, Namespace
 import flask
 import json
+import re
 import datetime as dt
+import hashlib
+import base64
+import threading
+import time
+import math
+import contextvars
+import requests
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+import jwt
+import h3
+from functools import lru_cache
+from collections import OrderedDict
 
 # Set up the app
-app = dash.Dash(__name__)
+# h3-js draws hexagon boundaries in the browser for BOUNDARY_MODE=client, the
+# tiles render mode, time animation and compare mode. A copy vendored as
+# assets/h3-js.umd.js is served with the other assets; without one the pinned
+# release is loaded from unpkg, checked against H3_JS_INTEGRITY when set.
+H3_JS_URL = "https://unpkg.com/h3-js@4.1.0/dist/h3-js.umd.js"
+H3_JS_INTEGRITY = os.getenv("H3_JS_INTEGRITY")
+external_scripts = []
+if not os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets", "h3-js.umd.js")):
+    print(f"Warning: assets/h3-js.umd.js not found, loading h3-js from {H3_JS_URL}")
+    h3_js_script = {"src": H3_JS_URL, "crossorigin": "anonymous"}
+    if H3_JS_INTEGRITY:
+        h3_js_script["integrity"] = H3_JS_INTEGRITY
+    external_scripts.append(h3_js_script)
+app = dash.Dash(__name__, external_scripts=external_scripts)
+# WSGI entry point for gunicorn (see gunicorn.conf.py)
+server = app.server
 
 # Check for environment variables but don't fail if they're not set (for development)
 DATABRICKS_WAREHOUSE_ID = os.getenv("DATABRICKS_WAREHOUSE_ID")
@@ -27,10 +58,6 @@ default_schema = os.getenv("DEFAULT_SCHEMA")
 default_table = os.getenv("DEFAULT_TABLE")
 default_column = os.getenv("DEFAULT_COLUMN")
 
-global_center = None
-global_zoom = None
-global_bounds = None
-
 if not DATABRICKS_WAREHOUSE_ID:
     print("Warning: DATABRICKS_WAREHOUSE_ID not set. Cannot pull data.")
 
@@ -50,206 +77,1519 @@ def get_databricks_server_hostname():
         DATABRICKS_SERVER_HOSTNAME = cfg.host
     return DATABRICKS_SERVER_HOSTNAME
 
-def sqlQuery(query: str) -> pd.DataFrame:
-    """Execute a SQL query and return the result as a pandas DataFrame."""
-    # print("RUNNING QUERY:", query)
-    DATABRICKS_SERVER_HOSTNAME = get_databricks_server_hostname()
-    DATABRICKS_TOKEN = get_databricks_token()
-    with sql.connect(
-        http_path=f"/sql/1.0/warehouses/{DATABRICKS_WAREHOUSE_ID}",
-        server_hostname=DATABRICKS_SERVER_HOSTNAME,
-        access_token=DATABRICKS_TOKEN
-    ) as connection:
+def get_token_expiry(token):
+    """Return the expiry of a JWT access token as a unix timestamp, or None for opaque tokens."""
+    if not token or token.count(".") != 2:
+        return None
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        return None
+    return claims.get("exp")
+
+# Pooled warehouse connections, keyed by (host, warehouse, token hash) so that
+# on-behalf-of users never share a session with each other.
+SQL_POOL_MAX_SIZE = int(os.getenv("SQL_POOL_MAX_SIZE", "4"))
+SQL_POOL_MAX_IDLE_SECONDS = int(os.getenv("SQL_POOL_MAX_IDLE_SECONDS", "300"))
+SQL_POOL_HEALTH_CHECK_SECONDS = int(os.getenv("SQL_POOL_HEALTH_CHECK_SECONDS", "60"))
+SQL_POOL_TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+# "connector" runs map queries on a pooled connection in the callback thread,
+# "statement_api" submits them through the SQL Statement Execution API, polls
+# them from the callback thread with a timeout and downloads the Arrow result
+# chunks in parallel
+SQL_EXECUTION_MODE = os.getenv("SQL_EXECUTION_MODE", "connector")
+# Base URL of the statements API, e.g. a local stand-in warehouse (default: the workspace)
+SQL_STATEMENT_API_URL = os.getenv("SQL_STATEMENT_API_URL")
+SQL_QUERY_TIMEOUT_SECONDS = float(os.getenv("SQL_QUERY_TIMEOUT_SECONDS", "120"))
+SQL_DOWNLOAD_THREADS = int(os.getenv("SQL_DOWNLOAD_THREADS", "4"))
+# Queries each worker process runs on the warehouse at once; the rest queue (0 disables)
+SQL_MAX_CONCURRENT_QUERIES = int(os.getenv("SQL_MAX_CONCURRENT_QUERIES", "8"))
+SQL_ADMISSION_TIMEOUT_SECONDS = float(os.getenv("SQL_ADMISSION_TIMEOUT_SECONDS", "60"))
+
+# "geojson" draws all hexagons as one GeoJSON layer styled in the browser,
+# "polygons" adds one dl.Polygon component per cell,
+# "tiles" has the browser fetch cacheable per-tile aggregates from /tiles
+MAP_RENDER_MODE = os.getenv("MAP_RENDER_MODE", "geojson")
+
+# Where hexagon boundaries come from: "server" computes them from the cell IDs
+# with a cached h3 lookup, "client" ships only cell IDs and lets h3-js draw
+# them in the browser, "sql" has the warehouse return GeoJSON per cell
+BOUNDARY_MODE = os.getenv("BOUNDARY_MODE", "server")
+# How cell IDs travel to the browser with BOUNDARY_MODE=client: "json" lists of
+# hex strings and counts, or "binary" base64 typed arrays
+HEX_CELL_TRANSPORT = os.getenv("HEX_CELL_TRANSPORT", "json")
+H3_BOUNDARY_CACHE_SIZE = int(os.getenv("H3_BOUNDARY_CACHE_SIZE", "500000"))
+
+# Progressive refresh: draw the viewport PROGRESSIVE_COARSE_OFFSET resolutions
+# coarser first, then replace it with full-resolution tiles, nearest to the
+# center first, PROGRESSIVE_TILES_PER_STEP tiles per step
+PROGRESSIVE_REFRESH = os.getenv("PROGRESSIVE_REFRESH", "true").lower() == "true"
+PROGRESSIVE_COARSE_OFFSET = int(os.getenv("PROGRESSIVE_COARSE_OFFSET", "2"))
+PROGRESSIVE_TILES_PER_STEP = int(os.getenv("PROGRESSIVE_TILES_PER_STEP", "16"))
+
+# Finest resolution is chosen so the viewport stays within this many cells (0 uses the zoom table)
+RENDER_CELL_BUDGET = int(os.getenv("RENDER_CELL_BUDGET", "50000"))
+# Hexagons are never drawn smaller than this many pixels across
+H3_MIN_HEX_PIXELS = float(os.getenv("H3_MIN_HEX_PIXELS", "4"))
+# Hard cap on cells drawn; sparse areas are rolled up to coarser cells to fit (0 disables)
+MAX_RENDER_CELLS = int(os.getenv("MAX_RENDER_CELLS", "0"))
+# Lower cell estimates with the per-tile cell counts earlier queries found in the same area
+DENSITY_AWARE_RESOLUTION = os.getenv("DENSITY_AWARE_RESOLUTION", "true").lower() == "true"
+
+# How long browsers may reuse a /tiles response before revalidating its ETag
+TILE_MAX_AGE_SECONDS = int(os.getenv("TILE_MAX_AGE_SECONDS", "60"))
+
+# Opt-in refresh whenever the viewport settles for AUTO_REFRESH_DEBOUNCE_MS
+AUTO_REFRESH_DEBOUNCE_MS = int(os.getenv("AUTO_REFRESH_DEBOUNCE_MS", "800"))
+
+# Time animation: most distinct values of the time column sent to the browser,
+# and how long each one is shown while playing
+TIME_MAX_FRAMES = int(os.getenv("TIME_MAX_FRAMES", "96"))
+TIME_FRAME_INTERVAL_MS = int(os.getenv("TIME_FRAME_INTERVAL_MS", "500"))
+
+# Rows per Arrow batch when streaming map data; 0 fetches the whole result at once
+ARROW_STREAM_BATCH_ROWS = int(os.getenv("ARROW_STREAM_BATCH_ROWS", "0"))
+
+connection_pool = {}
+connection_pool_lock = threading.Lock()
+
+def connection_pool_key(server_hostname, access_token):
+    token_hash = hashlib.sha256((access_token or "").encode()).hexdigest()
+    return (server_hostname, DATABRICKS_WAREHOUSE_ID, token_hash)
+
+def close_pooled_connection(entry):
+    try:
+        entry["connection"].close()
+    except Exception as e:
+        print(f"Error closing pooled connection: {e}")
+
+def evict_idle_connections(now):
+    """Drop idle connections that timed out or whose token is about to expire."""
+    evicted = []
+    with connection_pool_lock:
+        for key in list(connection_pool):
+            keep = []
+            for entry in connection_pool[key]:
+                idle_too_long = now - entry["last_used"] > SQL_POOL_MAX_IDLE_SECONDS
+                token_expiring = entry["expires_at"] is not None and entry["expires_at"] - SQL_POOL_TOKEN_EXPIRY_MARGIN_SECONDS <= now
+                if idle_too_long or token_expiring:
+                    evicted.append(entry)
+                else:
+                    keep.append(entry)
+            if keep:
+                connection_pool[key] = keep
+            else:
+                del connection_pool[key]
+    for entry in evicted:
+        close_pooled_connection(entry)
+
+def connection_is_healthy(entry, now):
+    if now - entry["last_used"] < SQL_POOL_HEALTH_CHECK_SECONDS:
+        return True
+    # Connections are only borrowed by the sqlQuery* functions, so this runs in
+    # the warehouse_admission slot the caller already holds
+    try:
+        with entry["connection"].cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        return True
+    except Exception as e:
+        print(f"Pooled connection failed health check: {e}")
+        return False
+
+@contextmanager
+def warehouse_connection(access_token=None):
+    """Borrow a warehouse connection from the pool, opening a new one if none is idle."""
+    server_hostname = get_databricks_server_hostname()
+    access_token = access_token or get_databricks_token()
+    key = connection_pool_key(server_hostname, access_token)
+    now = time.time()
+    evict_idle_connections(now)
+
+    entry = None
+    while entry is None:
+        with connection_pool_lock:
+            idle = connection_pool.get(key)
+            candidate = idle.pop() if idle else None
+        if candidate is None:
+            break
+        if connection_is_healthy(candidate, now):
+            entry = candidate
+        else:
+            close_pooled_connection(candidate)
+
+    if entry is None:
+        connection = sql.connect(
+            http_path=f"/sql/1.0/warehouses/{DATABRICKS_WAREHOUSE_ID}",
+            server_hostname=server_hostname,
+            access_token=access_token
+        )
         print("CONNECTION MADE")
-        with connection.cursor() as cursor:
-            cursor.execute(query)
-            columns = [desc[0] for desc in cursor.description]
-            rows = cursor.fetchall()
-            df = pd.DataFrame(rows, columns=columns)
-        return df
+        entry = {"connection": connection, "expires_at": get_token_expiry(access_token), "last_used": now}
 
-# Fetch the all h3 data
-def get_data(catalog=None, schema=None, table=None, column=None, resolution=9, bounds=None, column_resolution=None):
-    stime = dt.datetime.now()
-    
-    if not catalog or not schema or not table or not column:
-        print("No catalog, schema, table, or column provided. Returning empty data.")
-        return []
-    
     try:
-        bounds_wkt = bounds_to_wkt(bounds) if bounds else None
-        resolution = min([int(column_resolution), resolution])
-        print(f"RESOLUTION: {resolution}")
-        print(f"RESOLUTION QUERY TOOK:    {dt.datetime.now() - stime}")
-        stime = dt.datetime.now()
+        yield entry["connection"]
+    except BaseException:
+        # The session may be in a bad state, so don't hand it to the next caller.
+        close_pooled_connection(entry)
+        raise
+    entry["last_used"] = time.time()
+    with connection_pool_lock:
+        idle = connection_pool.setdefault(key, [])
+        if len(idle) < SQL_POOL_MAX_SIZE:
+            idle.append(entry)
+            entry = None
+    if entry is not None:
+        close_pooled_connection(entry)
 
-        query = f"""
+# Each page load has at most one generation of live map queries. Starting a
+# newer refresh cancels the statements still running for an older one. Page
+# loads that have run nothing for LIVE_SESSION_IDLE_SECONDS are forgotten.
+# This is per worker process: with GUNICORN_WORKERS > 1 an older refresh
+# served by another worker runs to completion. Its map is still never shown,
+# since Dash drops the response of a callback that was triggered again, and
+# refine batches carry their generation for mergeRefinedCells to check.
+query_session = contextvars.ContextVar("query_session", default=None)
+live_statements = {}
+live_statements_lock = threading.Lock()
+LIVE_SESSION_IDLE_SECONDS = 3600
+
+@contextmanager
+def session_queries(session_id, generation):
+    """Run the queries in this block as generation of session_id, cancelling older generations."""
+    if not session_id:
+        yield
+        return
+    superseded = []
+    now = time.time()
+    with live_statements_lock:
+        current = live_statements.get(session_id)
+        if current is None or current[0] < generation:
+            if current is not None:
+                superseded = list(current[1])
+            for idle_id in [key for key, entry in live_statements.items()
+                            if not entry[1] and now - entry[2] > LIVE_SESSION_IDLE_SECONDS]:
+                del live_statements[idle_id]
+            current = live_statements[session_id] = [generation, set(), now]
+        current[2] = now
+    for cursor in superseded:
+        print(f"Cancelling superseded query for session {session_id}")
+        try:
+            cursor.cancel()
+        except Exception as e:
+            print(f"Error cancelling query: {e}")
+    token = query_session.set((session_id, generation))
+    try:
+        yield
+    finally:
+        query_session.reset(token)
+
+def is_superseded(session_id, generation):
+    """Whether this worker has started a newer generation for session_id, so the result can be skipped."""
+    with live_statements_lock:
+        current = live_statements.get(session_id)
+    return current is not None and current[0] > generation
+
+@contextmanager
+def cancellable(cursor):
+    """Register cursor as a live statement of the current session generation while it runs."""
+    scope = query_session.get()
+    if scope is None:
+        yield cursor
+        return
+    session_id, generation = scope
+    with live_statements_lock:
+        current = live_statements.get(session_id)
+        live = current is not None and current[0] == generation
+        if live:
+            current[1].add(cursor)
+    if not live:
+        raise RuntimeError(f"Query for session {session_id} superseded before it started")
+    try:
+        yield cursor
+    finally:
+        with live_statements_lock:
+            current = live_statements.get(session_id)
+            if current is not None:
+                current[1].discard(cursor)
+
+# Statement Execution API. The callback thread submits a statement and polls it
+# until it finishes or SQL_QUERY_TIMEOUT_SECONDS pass, so it still waits for
+# the warehouse like the connector does; what the API adds is the timeout with
+# cancellation, and result chunks downloaded in parallel by a bounded pool.
+statement_download_pool = ThreadPoolExecutor(max_workers=SQL_DOWNLOAD_THREADS, thread_name_prefix="sql-chunk")
+STATEMENT_TERMINAL_STATES = {"SUCCEEDED", "FAILED", "CANCELED", "CLOSED"}
+STATEMENT_ARROW_TYPES = {"BOOLEAN": pa.bool_(), "INT": pa.int32(), "BIGINT": pa.int64(), "FLOAT": pa.float32(), "DOUBLE": pa.float64()}
+
+def statement_api_url():
+    if SQL_STATEMENT_API_URL:
+        return SQL_STATEMENT_API_URL.rstrip("/")
+    host = get_databricks_server_hostname()
+    host = host if host.startswith("http") else f"https://{host}"
+    return f"{host.rstrip('/')}/api/2.0/sql/statements"
+
+def statement_api_request(method, url, access_token, **kwargs):
+    response = requests.request(method, url, headers={"Authorization": f"Bearer {access_token}"}, timeout=30, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+def wait_for_statement(statement, access_token, deadline):
+    """Poll a submitted statement until it finishes or the deadline passes, backing off up to 1s."""
+    delay = 0.1
+    while statement["status"]["state"] not in STATEMENT_TERMINAL_STATES and time.time() < deadline:
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        delay = min(delay * 2, 1.0)
+        statement = statement_api_request("GET", f"{statement_api_url()}/{statement['statement_id']}", access_token)
+    return statement
+
+def download_statement_chunk(statement_id, chunk_index, access_token, links):
+    """Arrow table for one result chunk; links are the external links already known for the statement."""
+    link = next((l for l in links if l["chunk_index"] == chunk_index), None)
+    if link is None:
+        link = statement_api_request("GET", f"{statement_api_url()}/{statement_id}/result/chunks/{chunk_index}", access_token)["external_links"][0]
+    # External links are presigned, so they must be fetched without the workspace token
+    response = requests.get(link["external_link"], headers=link.get("http_headers") or {}, timeout=60)
+    response.raise_for_status()
+    return pa.ipc.open_stream(response.content).read_all()
+
+def empty_statement_table(manifest):
+    columns = manifest.get("schema", {}).get("columns", [])
+    return pa.table({c["name"]: pa.array([], type=STATEMENT_ARROW_TYPES.get(c.get("type_name"), pa.string())) for c in columns})
+
+class StatementHandle:
+    """Stands in for a cursor in live_statements, so a superseded statement can be cancelled."""
+    def __init__(self, cancel):
+        self.cancel = cancel
+
+def sqlQueryStatementApi(query: str, access_token=None, timeout=None) -> pa.Table:
+    """Execute a SQL query through the Statement Execution API and return an Arrow table.
+
+    Raises TimeoutError when the statement is not done within timeout seconds
+    (SQL_QUERY_TIMEOUT_SECONDS by default); the statement is cancelled. If the
+    timeout passes while chunks are downloading, the chunks already fetched are
+    returned with b"partial" set in the schema metadata.
+    """
+    # Token and URL are resolved here, the pool threads have no request context
+    access_token = access_token or get_databricks_token()
+    deadline = time.time() + (timeout or SQL_QUERY_TIMEOUT_SECONDS)
+    url = statement_api_url()
+    submitted = {}
+
+    def cancel():
+        # A cancel that arrives before the statement ID is known is applied once the submit returns
+        submitted["cancelled"] = True
+        if "id" not in submitted:
+            return
+        try:
+            statement_api_request("POST", f"{url}/{submitted['id']}/cancel", access_token)
+        except Exception as e:
+            print(f"Error cancelling statement {submitted['id']}: {e}")
+
+    with cancellable(StatementHandle(cancel)):
+        statement = statement_api_request("POST", url, access_token, json={
+            "statement": query,
+            "warehouse_id": DATABRICKS_WAREHOUSE_ID,
+            "wait_timeout": "0s",
+            "on_wait_timeout": "CONTINUE",
+            "disposition": "EXTERNAL_LINKS",
+            "format": "ARROW_STREAM",
+        })
+        statement_id = submitted["id"] = statement["statement_id"]
+        if submitted.get("cancelled"):
+            cancel()
+            raise RuntimeError(f"Statement {statement_id} superseded while it was submitted")
+
+        statement = wait_for_statement(statement, access_token, deadline)
+        state = statement["status"]["state"]
+        if state not in STATEMENT_TERMINAL_STATES:
+            cancel()
+            raise TimeoutError(f"Statement {statement_id} still {state} after {timeout or SQL_QUERY_TIMEOUT_SECONDS}s")
+        if state != "SUCCEEDED":
+            raise RuntimeError(f"Statement {statement_id} {state}: {statement['status'].get('error', {}).get('message')}")
+
+    manifest = statement.get("manifest", {})
+    links = statement.get("result", {}).get("external_links") or []
+    chunks = [statement_download_pool.submit(download_statement_chunk, statement_id, i, access_token, links)
+              for i in range(manifest.get("total_chunk_count", 0))]
+    tables = []
+    for chunk in chunks:
+        try:
+            tables.append(chunk.result(timeout=max(deadline - time.time(), 0)))
+        except FutureTimeoutError:
+            for pending in chunks:
+                pending.cancel()
+            print(f"PARTIAL RESULT: {len(tables)} of {len(chunks)} chunks of {statement_id} before the timeout")
+            break
+    table = pa.concat_tables(tables) if tables else empty_statement_table(manifest)
+    if len(tables) < len(chunks):
+        table = table.replace_schema_metadata({b"partial": b"true"})
+    return table
+
+def is_partial_result(table):
+    return bool(table.schema.metadata) and table.schema.metadata.get(b"partial") == b"true"
+
+# Admission control: at most SQL_MAX_CONCURRENT_QUERIES statements per
+# warehouse run at once from this process, the rest wait in line, so a burst of
+# refreshes queues here instead of scaling up or queueing on the warehouse.
+admission_semaphores = {}
+query_stats = {"queued": 0, "running": 0, "max_queued": 0, "admitted": 0, "rejected": 0,
+               "wait_seconds_total": 0.0, "wait_seconds_max": 0.0, "executed": 0, "coalesced": 0}
+query_stats_lock = threading.Lock()
+
+@contextmanager
+def warehouse_admission():
+    """Hold one of the warehouse's query slots, waiting up to SQL_ADMISSION_TIMEOUT_SECONDS for it."""
+    if SQL_MAX_CONCURRENT_QUERIES <= 0:
+        yield
+        return
+    with query_stats_lock:
+        semaphore = admission_semaphores.setdefault(DATABRICKS_WAREHOUSE_ID, threading.BoundedSemaphore(SQL_MAX_CONCURRENT_QUERIES))
+        query_stats["queued"] += 1
+        query_stats["max_queued"] = max(query_stats["max_queued"], query_stats["queued"])
+    start = time.time()
+    admitted = semaphore.acquire(timeout=SQL_ADMISSION_TIMEOUT_SECONDS)
+    waited = time.time() - start
+    with query_stats_lock:
+        query_stats["queued"] -= 1
+        query_stats["wait_seconds_total"] += waited
+        query_stats["wait_seconds_max"] = max(query_stats["wait_seconds_max"], waited)
+        query_stats["admitted" if admitted else "rejected"] += 1
+        if admitted:
+            query_stats["running"] += 1
+    if not admitted:
+        raise TimeoutError(f"No warehouse query slot free after {waited:.0f}s")
+    try:
+        yield
+    finally:
+        with query_stats_lock:
+            query_stats["running"] -= 1
+        semaphore.release()
+
+def get_query_stats():
+    with query_stats_lock:
+        stats = dict(query_stats, in_flight=len(inflight_queries), max_concurrent=SQL_MAX_CONCURRENT_QUERIES)
+    stats["wait_seconds_avg"] = stats["wait_seconds_total"] / stats["admitted"] if stats["admitted"] else 0.0
+    return stats
+
+# Single-flight: identical queries already running for the same access scope
+# are not sent again; later callers wait for the first one and share its result.
+inflight_queries = {}
+
+def query_flight_key(query, access_token=None, share_scope=None):
+    """Key of a query for coalescing: warehouse, whitespace-normalized SQL and who may see the result.
+
+    share_scope is a get_cache_scope result; a ("version", v) scope lets users
+    who passed the table access check share one execution, anything else
+    coalesces per user only.
+    """
+    if share_scope is None or share_scope[0] != "version":
+        share_scope = ("user", get_user_scope(access_token))
+    return (DATABRICKS_WAREHOUSE_ID, " ".join(query.split()), share_scope)
+
+def single_flight(key, execute):
+    with query_stats_lock:
+        flight = inflight_queries.get(key)
+        leader = flight is None
+        if leader:
+            flight = inflight_queries[key] = Future()
+        query_stats["executed" if leader else "coalesced"] += 1
+    if not leader:
+        try:
+            return flight.result()
+        except Exception as e:
+            # The first caller's query failed or was cancelled with its session; run it for this caller
+            print(f"Coalesced query failed ({e}), running it again")
+            return execute()
+    try:
+        result = execute()
+        flight.set_result(result)
+        return result
+    except BaseException as e:
+        flight.set_exception(e)
+        raise
+    finally:
+        with query_stats_lock:
+            del inflight_queries[key]
+
+def sqlQueryArrow(query: str, access_token=None, share_scope=None) -> pa.Table:
+    """Execute a SQL query and return the result as a columnar Arrow table.
+
+    Identical concurrent queries share one execution (see query_flight_key).
+    """
+    def execute():
+        with warehouse_admission():
+            if SQL_EXECUTION_MODE == "statement_api":
+                return sqlQueryStatementApi(query, access_token)
+            with warehouse_connection(access_token) as connection:
+                with connection.cursor() as cursor, cancellable(cursor):
+                    cursor.execute(query)
+                    return cursor.fetchall_arrow()
+    return single_flight(query_flight_key(query, access_token, share_scope), execute)
+
+def sqlQueryArrowBatches(query: str, batch_rows=10000, access_token=None):
+    """Execute a SQL query and yield the result as Arrow record batches of up to batch_rows rows."""
+    with warehouse_admission():
+        yield from stream_query_batches(query, batch_rows, access_token)
+
+def stream_query_batches(query, batch_rows, access_token):
+    if SQL_EXECUTION_MODE == "statement_api":
+        yield from sqlQueryStatementApi(query, access_token).to_batches(max_chunksize=batch_rows)
+        return
+    with warehouse_connection(access_token) as connection:
+        with connection.cursor() as cursor, cancellable(cursor):
+            cursor.execute(query)
+            while True:
+                chunk = cursor.fetchmany_arrow(batch_rows)
+                if chunk.num_rows == 0:
+                    break
+                yield from chunk.to_batches()
+
+def get_user_scope(access_token=None):
+    """Stable, non-reversible identifier for the caller's credentials, for keying per-user caches."""
+    access_token = access_token or get_databricks_token()
+    return hashlib.sha256((access_token or "").encode()).hexdigest()[:16]
+
+# Stored H3 columns per (table, column): the column itself plus "siblings" that
+# hold the same point at other resolutions, e.g. pickup_cell_8/10/12
+h3_column_family_cache = {}
+H3_COLUMN_PROBE_ROWS = 1000
+
+def describe_table_columns(catalog, schema, table):
+    """{column name: upper-case SQL type} from DESCRIBE TABLE."""
+    result = sqlQueryArrow(f"DESCRIBE TABLE {catalog}.{schema}.{table}")
+    columns = {}
+    for name, data_type in zip(result.column('col_name').to_pylist(), result.column('data_type').to_pylist()):
+        if not name or name.startswith("#"):
+            # Partitioning/clustering sections follow the column list
+            break
+        columns[name] = data_type.upper()
+    return columns
+
+def get_h3_column_family(catalog, schema, table, column):
+    """Resolution and type of column and of its sibling H3 columns, inspected once per process.
+
+    Siblings share the column's name up to digits and its type, and are checked
+    on a sample of rows to be parents or children of the column. Returns
+    {column name: {"resolution": int, "data_type": str}}.
+    """
+    key = (f"{catalog}.{schema}.{table}".lower(), column.lower())
+    if key in h3_column_family_cache:
+        return h3_column_family_cache[key]
+
+    table_columns = describe_table_columns(catalog, schema, table)
+    data_type = table_columns.get(column, "BIGINT")
+    family_name = re.sub(r"\d+", "", column)
+    candidates = [column] + [
+        name for name, name_type in table_columns.items()
+        if name != column and name_type == data_type and re.sub(r"\d+", "", name) == family_name
+    ]
+
+    selects = []
+    for i, name in enumerate(candidates):
+        selects.append(f"first(h3_resolution({name}), true) as r{i}")
+        selects.append(f"""bool_and(CASE WHEN {name} IS NULL OR {column} IS NULL THEN true
+                       WHEN h3_resolution({name}) <= h3_resolution({column}) THEN h3_toparent({column}, h3_resolution({name})) = {name}
+                       ELSE h3_toparent({name}, h3_resolution({column})) = {column} END) as m{i}""")
+    sample = ", ".join(candidates)
+    probe = sqlQueryArrow(f"""
+        SELECT {", ".join(selects)}
+        FROM (SELECT {sample} FROM {catalog}.{schema}.{table} WHERE {column} IS NOT NULL LIMIT {H3_COLUMN_PROBE_ROWS})
+    """).to_pylist()[0]
+
+    family = {}
+    for i, name in enumerate(candidates):
+        if probe[f"r{i}"] is not None and probe[f"m{i}"]:
+            family[name] = {"resolution": int(probe[f"r{i}"]), "data_type": data_type}
+    if column not in family:
+        family[column] = {"resolution": probe["r0"], "data_type": data_type}
+    print(f"H3 COLUMNS FOR {column}: {family}")
+    h3_column_family_cache[key] = family
+    return family
+
+# Columns of a table that hold H3 cells, with their resolution, per table
+h3_columns_cache = {}
+
+def get_h3_columns(catalog, schema, table):
+    """{column name: resolution} for the BIGINT and STRING columns whose sampled values are all valid H3 cells.
+
+    Probed once per process with a single query over a sample of rows.
+    """
+    key = f"{catalog}.{schema}.{table}".lower()
+    if key in h3_columns_cache:
+        return h3_columns_cache[key]
+    candidates = [name for name, data_type in describe_table_columns(catalog, schema, table).items()
+                  if data_type in ("BIGINT", "STRING")]
+    columns = {}
+    if candidates:
+        selects = []
+        for i, name in enumerate(candidates):
+            selects.append(f"first(CASE WHEN h3_isvalid({name}) THEN h3_resolution({name}) END, true) as r{i}")
+            selects.append(f"bool_and({name} IS NULL OR h3_isvalid({name})) as v{i}")
+        probe = sqlQueryArrow(f"""
+            SELECT {", ".join(selects)}
+            FROM (SELECT {", ".join(candidates)} FROM {catalog}.{schema}.{table} LIMIT {H3_COLUMN_PROBE_ROWS})
+        """).to_pylist()[0]
+        columns = {name: int(probe[f"r{i}"]) for i, name in enumerate(candidates)
+                   if probe[f"r{i}"] is not None and probe[f"v{i}"]}
+    h3_columns_cache[key] = columns
+    return columns
+
+def h3_cell_sql(family, column, resolution):
+    """SQL for the H3 cell of column at resolution, read from the cheapest equivalent stored column.
+
+    A stored column at exactly that resolution is used as-is; otherwise the
+    coarsest stored column that is still fine enough goes through h3_toparent.
+    """
+    finer = sorted(
+        (info["resolution"], name) for name, info in family.items()
+        if info["resolution"] is not None and info["resolution"] >= resolution
+    )
+    if not finer:
+        return f"h3_toparent({column}, {resolution})"
+    stored_resolution, name = finer[0]
+    return name if stored_resolution == resolution else f"h3_toparent({name}, {resolution})"
+
+def h3_sql_literal(cell, data_type):
+    """Literal for an integer H3 cell that compares against a column of data_type."""
+    return f"'{cell:x}'" if data_type == "STRING" else str(cell)
+
+# Above this many BETWEEN ranges the viewport filter falls back to an IN list of tiles
+H3_MAX_RANGE_PREDICATES = int(os.getenv("H3_MAX_RANGE_PREDICATES", "64"))
+
+def h3_child_range(cell, child_resolution):
+    """Smallest and largest integer ID of the children of cell at child_resolution.
+
+    Children differ from their parent only in the digits below its resolution,
+    so every child lies in [all those digits 0, all those digits 6].
+    """
+    resolution = (cell >> H3_RES_SHIFT) & 0xF
+    child = (cell & ~(0xF << H3_RES_SHIFT)) | (child_resolution << H3_RES_SHIFT)
+    low = child
+    high = child
+    for digit in range(resolution + 1, child_resolution + 1):
+        shift = (15 - digit) * 3
+        low &= ~(7 << shift)
+        high = (high & ~(7 << shift)) | (6 << shift)
+    return low, high
+
+def h3_id_ranges(cells, child_resolution):
+    """Compact cells and turn them into sorted, merged [low, high] child ID ranges."""
+    compacted = sorted(h3.str_to_int(cell) for cell in h3.compact_cells([h3.int_to_str(cell) for cell in cells]))
+    ranges = []
+    previous = None
+    for cell in compacted:
+        low, high = h3_child_range(cell, child_resolution)
+        resolution = (cell >> H3_RES_SHIFT) & 0xF
+        shift = (15 - resolution) * 3
+        # Consecutive siblings leave only invalid IDs (digit 7) between their ranges
+        if (previous is not None and (previous >> H3_RES_SHIFT) & 0xF == resolution
+                and previous >> (shift + 3) == cell >> (shift + 3)
+                and ((previous >> shift) & 7) + 1 == (cell >> shift) & 7):
+            ranges[-1] = (ranges[-1][0], high)
+        else:
+            ranges.append((low, high))
+        previous = cell
+    # Integer IDs sort by resolution first, so order the ranges by position
+    return sorted(ranges)
+
+def h3_range_predicate(column_sql, cells, child_resolution):
+    """BETWEEN predicate on a BIGINT column of child_resolution cells that lie within cells.
+
+    Plain ranges on the stored column let the warehouse skip files using the
+    clustered layout. Returns None if more than H3_MAX_RANGE_PREDICATES ranges
+    would be needed.
+    """
+    ranges = h3_id_ranges(cells, child_resolution)
+    if len(ranges) > H3_MAX_RANGE_PREDICATES:
+        return None
+    return "(" + " OR ".join(f"{column_sql} BETWEEN {low} AND {high}" for low, high in ranges) + ")"
+
+def h3_bigint_cell_sql(family, column, resolution):
+    """h3_cell_sql as a BIGINT, since the payload builder always takes BIGINT cell IDs."""
+    cell_expr = h3_cell_sql(family, column, resolution)
+    return f"h3_stringtoh3({cell_expr})" if family[column]["data_type"] == "STRING" else cell_expr
+
+def h3_tiles_predicate(family, column, tiles, tile_resolution):
+    """WHERE clause keeping rows of column that fall in tiles, or all rows without tiles."""
+    data_type = family[column]["data_type"]
+    column_resolution = family[column]["resolution"]
+    where = "1=1"
+    if tiles and data_type == "BIGINT" and column_resolution is not None:
+        where = h3_range_predicate(column, tiles, column_resolution) or where
+    if tiles and where == "1=1":
+        tile_list = ", ".join(h3_sql_literal(tile, data_type) for tile in tiles)
+        where = f"{h3_cell_sql(family, column, tile_resolution)} IN ({tile_list})"
+    return where
+
+def build_data_query(catalog, schema, table, column, resolution, tiles=None, tile_resolution=None, family=None):
+    family = family or {column: {"resolution": None, "data_type": "BIGINT"}}
+    cell_expr = h3_bigint_cell_sql(family, column, resolution)
+    where = h3_tiles_predicate(family, column, tiles, tile_resolution)
+    boundary_select = "h3_boundaryasgeojson(h3_cell_id) as hex_boundary," if BOUNDARY_MODE == "sql" else ""
+    return f"""
                     WITH cell_agg AS (
                     SELECT
-                        h3_toparent({column}, {resolution}) as h3_cell_id,
+                        {cell_expr} as h3_cell_id,
                         count(*) as count
                     FROM {catalog}.{schema}.{table}
-                    WHERE {f"h3_toparent({column}, {resolution}) IN (SELECT EXPLODE(H3_COVERASH3('{bounds_wkt}', {resolution})))" if bounds_wkt else "1=1"}
+                    WHERE {where}
                     GROUP BY h3_cell_id
                     )
-                    SELECT h3_boundaryasgeojson(h3_cell_id) as hex_boundary,
+                    SELECT {boundary_select}
+                            h3_cell_id,
                             count
                     FROM cell_agg
                     ORDER BY count DESC
         """
-        # print(query)
-        data = sqlQuery(query)
-        # print(data.head())
-        # Convert any ndarray columns to lists
-        for col in data.columns:
-            if isinstance(data[col].iloc[0], np.ndarray):
-                data[col] = data[col].apply(list)
+
+def build_time_query(catalog, schema, table, column, resolution, frame_sql, max_frames, tiles=None, tile_resolution=None, family=None):
+    """Count rows per H3 cell and time frame, for the first max_frames frames in ascending order.
+
+    frame_sql is the SQL expression a row's frame is read from, such as a
+    small integer column or a date_trunc of a timestamp.
+    """
+    family = family or {column: {"resolution": None, "data_type": "BIGINT"}}
+    cell_expr = h3_bigint_cell_sql(family, column, resolution)
+    where = h3_tiles_predicate(family, column, tiles, tile_resolution)
+    return f"""
+                    WITH cell_agg AS (
+                    SELECT
+                        {cell_expr} as h3_cell_id,
+                        {frame_sql} as frame,
+                        count(*) as count
+                    FROM {catalog}.{schema}.{table}
+                    WHERE {where} AND {frame_sql} IS NOT NULL
+                    GROUP BY h3_cell_id, frame
+                    ),
+                    first_frames AS (
+                    SELECT DISTINCT frame FROM cell_agg ORDER BY frame LIMIT {max_frames}
+                    )
+                    SELECT h3_cell_id,
+                           frame,
+                           count
+                    FROM cell_agg
+                    WHERE frame IN (SELECT frame FROM first_frames)
+        """
+
+def build_compare_query(catalog, schema, table, columns, resolution, tiles=None, tile_resolution=None, families=None):
+    """Count rows per H3 cell for two H3 columns in one scan, as count_a and count_b.
+
+    stack() emits each row once per column, so both aggregates come from a
+    single pass over the table instead of one query per column.
+    """
+    column_a, column_b = columns
+    families = families or [{column: {"resolution": None, "data_type": "BIGINT"}} for column in columns]
+    cell_a = h3_bigint_cell_sql(families[0], column_a, resolution)
+    cell_b = h3_bigint_cell_sql(families[1], column_b, resolution)
+    where_a = h3_tiles_predicate(families[0], column_a, tiles, tile_resolution)
+    where_b = h3_tiles_predicate(families[1], column_b, tiles, tile_resolution)
+    return f"""
+                    WITH stacked AS (
+                    SELECT stack(2, 0, {cell_a}, 1, {cell_b}) AS (source, h3_cell_id)
+                    FROM {catalog}.{schema}.{table}
+                    WHERE ({where_a}) OR ({where_b})
+                    )
+                    SELECT h3_cell_id,
+                           count_if(source = 0) as count_a,
+                           count_if(source = 1) as count_b
+                    FROM stacked
+                    WHERE h3_cell_id IS NOT NULL
+                    GROUP BY h3_cell_id
+        """
+
+def build_pyramid_query(pyramid_table, column, resolution, tiles=None, tile_resolution=None):
+    """Query one level of a precomputed aggregate pyramid instead of the raw table."""
+    where = f"source_column = '{column}' AND resolution = {resolution}"
+    if tiles:
+        tile_list = ", ".join(str(tile) for tile in tiles)
+        tile_predicate = h3_range_predicate("h3_cell_id", tiles, resolution) or f"h3_toparent(h3_cell_id, {tile_resolution}) IN ({tile_list})"
+        where += f" AND {tile_predicate}"
+    boundary_select = "h3_boundaryasgeojson(h3_cell_id) as hex_boundary," if BOUNDARY_MODE == "sql" else ""
+    return f"""
+                    SELECT {boundary_select}
+                            h3_cell_id,
+                            count
+                    FROM {pyramid_table}
+                    WHERE {where}
+                    ORDER BY count DESC
+        """
+
+# Aggregate pyramids built by notebooks/nb03-build-h3-aggregate-pyramid.py live
+# next to their source table and record, per source column, the resolutions
+# built and the source version they reflect as table properties.
+PYRAMID_TABLE_SUFFIX = os.getenv("PYRAMID_TABLE_SUFFIX", "_h3_pyramid")
+
+pyramid_properties_cache = {}
+
+def get_pyramid_properties(catalog, schema, table):
+    """Table properties of a table's aggregate pyramid, or None if it has none. Cached per user."""
+    pyramid_table = f"{catalog}.{schema}.{table}{PYRAMID_TABLE_SUFFIX}"
+    key = (get_user_scope(), pyramid_table.lower())
+    checked = pyramid_properties_cache.get(key)
+    if checked is not None and time.time() - checked[0] < TABLE_VERSION_TTL_SECONDS:
+        return checked[1]
+    try:
+        result = sqlQueryArrow(f"SHOW TBLPROPERTIES {pyramid_table}")
+        properties = dict(zip(result.column('key').to_pylist(), result.column('value').to_pylist()))
+    except Exception:
+        properties = None
+    pyramid_properties_cache[key] = (time.time(), properties)
+    return properties
+
+def find_pyramid_table(catalog, schema, table, column, resolution):
+    """Name of an up-to-date pyramid holding column at resolution, or None to query the raw table.
+
+    Pyramids are skipped for tables with row filters or column masks, since
+    pre-aggregated counts would bypass them.
+    """
+    version = get_table_version(catalog, schema, table)
+    if version is None or table_has_access_policies(catalog, schema, table, version):
+        return None
+    properties = get_pyramid_properties(catalog, schema, table)
+    if not properties:
+        return None
+    levels = properties.get(f"h3_pyramid.levels.{column}", "")
+    source_version = properties.get(f"h3_pyramid.source_version.{column}")
+    if str(resolution) not in levels.split(",") or source_version is None or int(source_version) != version:
+        return None
+    return f"{catalog}.{schema}.{table}{PYRAMID_TABLE_SUFFIX}"
+
+# Viewport tile cache. The viewport is covered with coarse H3 parent cells
+# ("tiles") and aggregates are cached per (table, column, resolution, scope, tile),
+# so a refresh only queries the tiles that are not cached yet. The scope is the
+# table's Delta version when entries can be shared between users, otherwise the
+# user's identity. Shared entries can also be persisted as Parquet files.
+VIEWPORT_TILE_RES_OFFSET = int(os.getenv("VIEWPORT_TILE_RES_OFFSET", "3"))
+TILE_CACHE_MAX_TILES = int(os.getenv("TILE_CACHE_MAX_TILES", "50000"))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_MAX_FILES = int(os.getenv("RESULT_CACHE_DISK_MAX_FILES", "200000"))
+TABLE_VERSION_TTL_SECONDS = int(os.getenv("TABLE_VERSION_TTL_SECONDS", "60"))
+
+tile_cache = OrderedDict()
+tile_cache_lock = threading.Lock()
+tile_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "disk_hits": 0, "disk_writes": 0}
+
+table_version_cache = {}
+table_policy_cache = {}
+
+def get_table_version(catalog, schema, table):
+    """Current Delta version of a table as seen by the caller, or None if it has no history.
+
+    Runs with the caller's credentials and is cached per user for
+    TABLE_VERSION_TTL_SECONDS, so it doubles as the access check before a user
+    is served cache entries shared with other users.
+    """
+    key = (get_user_scope(), f"{catalog}.{schema}.{table}".lower())
+    checked = table_version_cache.get(key)
+    if checked is not None and time.time() - checked[0] < TABLE_VERSION_TTL_SECONDS:
+        return checked[1]
+    try:
+        history = sqlQueryArrow(f"DESCRIBE HISTORY {catalog}.{schema}.{table} LIMIT 1")
+        version = history.column('version')[0].as_py()
+    except Exception as e:
+        print(f"Could not read table version for {catalog}.{schema}.{table}: {e}")
+        version = None
+    table_version_cache[key] = (time.time(), version)
+    return version
+
+def table_has_access_policies(catalog, schema, table, version):
+    """Whether row filters or column masks make query results differ between users."""
+    key = (f"{catalog}.{schema}.{table}".lower(), version)
+    if key not in table_policy_cache:
+        query = f"""
+            SELECT
+                (SELECT count(*) FROM {catalog}.information_schema.row_filters
+                 WHERE table_schema = '{schema}' AND table_name = '{table}')
+              + (SELECT count(*) FROM {catalog}.information_schema.column_masks
+                 WHERE table_schema = '{schema}' AND table_name = '{table}') as policies
+        """
+        try:
+            table_policy_cache[key] = sqlQueryArrow(query).column('policies')[0].as_py() > 0
+        except Exception as e:
+            # Can't tell, so don't share
+            print(f"Could not check access policies for {catalog}.{schema}.{table}: {e}")
+            table_policy_cache[key] = True
+    return table_policy_cache[key]
+
+def get_cache_scope(catalog, schema, table):
+    """Cache scope for the caller: the table version if results can be shared, else the user."""
+    version = get_table_version(catalog, schema, table)
+    if version is None or table_has_access_policies(catalog, schema, table, version):
+        return ("user", get_user_scope())
+    return ("version", version)
+
+def result_cache_path(key):
+    digest = hashlib.sha256(repr(key).encode()).hexdigest()
+    return os.path.join(RESULT_CACHE_DIR, digest[:2], f"{digest}.parquet")
+
+def read_result_cache_file(key):
+    path = result_cache_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        return pq.read_table(path)
+    except Exception as e:
+        print(f"Could not read cached result {path}: {e}")
+        return None
+
+def write_result_cache_files(entries):
+    """Persist shared tile entries as Parquet files and prune the oldest past the file limit."""
+    for key, data in entries:
+        path = result_cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        pq.write_table(data, tmp_path)
+        os.replace(tmp_path, path)
+    with tile_cache_lock:
+        tile_cache_stats["disk_writes"] += len(entries)
+        prune = tile_cache_stats["disk_writes"] % 1000 < len(entries)
+    if prune:
+        files = [os.path.join(root, name) for root, _, names in os.walk(RESULT_CACHE_DIR) for name in names if name.endswith(".parquet")]
+        if len(files) > RESULT_CACHE_DISK_MAX_FILES:
+            files.sort(key=os.path.getmtime)
+            for path in files[:len(files) - RESULT_CACHE_DISK_MAX_FILES]:
+                os.remove(path)
+
+# H3 index bit layout: 4 resolution bits at 52-55, then fifteen 3-bit digits
+H3_RES_SHIFT = 52
+H3_RES_MASK = np.int64(0xF << H3_RES_SHIFT)
+
+def h3_parent_ids(cells, resolution):
+    """Vectorized h3_toparent for an int64 array of cells at or finer than resolution."""
+    unused_digits = np.int64((1 << ((15 - resolution) * 3)) - 1)
+    return (cells & ~H3_RES_MASK) | np.int64(resolution << H3_RES_SHIFT) | unused_digits
+
+def longitude_spans(west, east):
+    """(west, east) pieces of a longitude range, wrapped into [-180, 180] and at most 90° wide.
+
+    h3 reads a polygon edge spanning more than 180° as crossing the
+    antimeridian, so wide or wrapped viewports are split before polyfilling.
+    """
+    width = east - west if east >= west else east - west + 360
+    if width >= 360:
+        west, east = -180.0, 180.0
+    else:
+        west = (west + 180) % 360 - 180
+        east = west + width
+    spans = [(west, min(east, 180.0))]
+    if east > 180:
+        spans.append((-180.0, east - 360))
+    pieces = []
+    for start, end in spans:
+        count = max(math.ceil((end - start) / 90), 1)
+        pieces.extend((start + (end - start) * i / count, start + (end - start) * (i + 1) / count) for i in range(count))
+    return pieces
+
+def viewport_tiles(bounds, tile_resolution):
+    """Integer H3 cells at tile_resolution that overlap the [southwest, northeast] bounds."""
+    sw, ne = bounds
+    south, north = max(sw[0], -90.0), min(ne[0], 90.0)
+    cells = set()
+    for west, east in longitude_spans(sw[1], ne[1]):
+        viewport = h3.LatLngPoly([(south, west), (north, west), (north, east), (south, east)])
+        cells.update(h3.h3shape_to_cells_experimental(viewport, tile_resolution, contain="overlap"))
+    return sorted(h3.str_to_int(cell) for cell in cells)
+
+def tile_cache_lookup(query_key, tiles):
+    """Split tiles into cached Arrow tables and the list of tiles still to query."""
+    found = []
+    missing = []
+    with tile_cache_lock:
+        for tile in tiles:
+            key = query_key + (tile,)
+            entry = tile_cache.get(key)
+            if entry is None:
+                missing.append(tile)
+            else:
+                tile_cache.move_to_end(key)
+                found.append(entry)
+        tile_cache_stats["hits"] += len(found)
+
+    if RESULT_CACHE_DIR and query_key[-1][0] == "version":
+        still_missing = []
+        for tile in missing:
+            entry = read_result_cache_file(query_key + (tile,))
+            if entry is None:
+                still_missing.append(tile)
+            else:
+                found.append(entry)
+                with tile_cache_lock:
+                    tile_cache[query_key + (tile,)] = entry
+                    tile_cache_stats["disk_hits"] += 1
+        missing = still_missing
+
+    with tile_cache_lock:
+        tile_cache_stats["misses"] += len(missing)
+    return found, missing
+
+def tile_cache_store(query_key, tiles, tile_resolution, data):
+    """Split a query result by tile and cache each slice, including empty tiles."""
+    parents = h3_parent_ids(cell_ids_to_int(data.column('h3_cell_id')), tile_resolution)
+    order = np.argsort(parents, kind="stable")
+    data = data.take(order)
+    parents = parents[order]
+    starts = np.searchsorted(parents, tiles, side="left")
+    ends = np.searchsorted(parents, tiles, side="right")
+    entries = [(query_key + (tile,), data.slice(start, end - start)) for tile, start, end in zip(tiles, starts, ends)]
+    with tile_cache_lock:
+        for key, entry in entries:
+            tile_cache[key] = entry
+            tile_cache.move_to_end(key)
+        while len(tile_cache) > TILE_CACHE_MAX_TILES:
+            tile_cache.popitem(last=False)
+            tile_cache_stats["evictions"] += 1
+    if RESULT_CACHE_DIR and query_key[-1][0] == "version":
+        try:
+            write_result_cache_files(entries)
+        except Exception as e:
+            print(f"Could not persist cached results: {e}")
+
+def get_tile_cache_stats():
+    with tile_cache_lock:
+        return dict(tile_cache_stats, tiles=len(tile_cache), max_tiles=TILE_CACHE_MAX_TILES)
+
+def tile_resolution_for(resolution):
+    return max(resolution - VIEWPORT_TILE_RES_OFFSET, 0)
+
+def plan_data_query(catalog, schema, table, column, resolution, bounds, tiles=None):
+    """Work out the tiles for a viewport and which of them need a warehouse query.
+
+    tiles, if given, are the integer tiles to fetch instead of those covering bounds.
+    Returns (cached tables, query or None, cache key, all tiles, missing tiles, tile resolution).
+    """
+    pyramid_table = find_pyramid_table(catalog, schema, table, column, resolution)
+    if pyramid_table:
+        print(f"USING PYRAMID: {pyramid_table}")
+
+    def build_query(tiles=None, tile_resolution=None):
+        if pyramid_table:
+            return build_pyramid_query(pyramid_table, column, resolution, tiles, tile_resolution)
+        family = get_h3_column_family(catalog, schema, table, column)
+        return build_data_query(catalog, schema, table, column, resolution, tiles, tile_resolution, family)
+
+    if not bounds and tiles is None:
+        return [], build_query(), None, None, None, None
+    tile_resolution = tile_resolution_for(resolution)
+    if tiles is None:
+        tiles = viewport_tiles(bounds, tile_resolution)
+    query_key = (f"{catalog}.{schema}.{table}".lower(), column.lower(), resolution, get_cache_scope(catalog, schema, table))
+    cached, missing = tile_cache_lookup(query_key, tiles)
+    print(f"VIEWPORT TILES: {len(tiles)} at resolution {tile_resolution}, {len(cached)} cached, {len(missing)} to query")
+    query = build_query(missing, tile_resolution) if missing else None
+    return cached, query, query_key, tiles, missing, tile_resolution
+
+def fetch_data(catalog, schema, table, column, resolution=9, bounds=None, column_resolution=None, tiles=None, max_cells=0, partial_ok=True):
+    """The aggregates for get_data, raising instead of returning empty data when a query fails.
+
+    With partial_ok=False a statement timeout or a partially downloaded result
+    raises too, rather than returning only the cached tiles or the chunks that
+    arrived.
+    """
+    resolution = min([int(column_resolution), resolution])
+    print(f"RESOLUTION: {resolution}")
+    cached, query, query_key, tiles, missing, tile_resolution = plan_data_query(catalog, schema, table, column, resolution, bounds, tiles)
+    # print(query)
+    tables = list(cached)
+    complete = True
+    if query is not None:
+        try:
+            fresh = sqlQueryArrow(query, share_scope=query_key[3] if query_key else None)
+        except TimeoutError as e:
+            if not tables or not partial_ok:
+                raise
+            # Draw the cached tiles rather than nothing
+            print(f"{e}, showing {len(tables)} cached tiles only")
+            fresh = None
+            complete = False
+        if fresh is not None:
+            if is_partial_result(fresh):
+                if not partial_ok:
+                    raise RuntimeError("Only part of the query result could be downloaded")
+                complete = False
+            elif query_key is not None:
+                tile_cache_store(query_key, missing, tile_resolution, fresh)
+            tables.append(fresh)
+    data = pa.concat_tables(tables).sort_by([("count", "descending")])
+    if complete and tiles:
+        record_tile_density(catalog, schema, table, column, resolution, tiles, tile_resolution, cell_ids_to_int(data.column('h3_cell_id')))
+    return cap_render_cells(data, max_cells, resolution)
+
+# Fetch the all h3 data
+def get_data(catalog=None, schema=None, table=None, column=None, resolution=9, bounds=None, column_resolution=None, tiles=None, max_cells=0):
+    stime = dt.datetime.now()
+    
+    if not catalog or not schema or not table or not column:
+        print("No catalog, schema, table, or column provided. Returning empty data.")
+        return []
+    
+    try:
+        data = fetch_data(catalog, schema, table, column, resolution, bounds, column_resolution, tiles, max_cells)
     except Exception as e:
         print(f"An error occurred in querying data: {str(e)}")
         print("Returning empty data.")
         data = []
     
     print(f"DATA QUERY TOOK:    {dt.datetime.now() - stime}")
-    # print(data.head())
     print("ROWS:", len(data))
     return data
 
-def get_catalogs():
-    DATABRICKS_SERVER_HOSTNAME = get_databricks_server_hostname()
-    DATABRICKS_TOKEN = get_databricks_token()
-    with sql.connect(
-        http_path=f"/sql/1.0/warehouses/{DATABRICKS_WAREHOUSE_ID}",
-        server_hostname=DATABRICKS_SERVER_HOSTNAME,
-        access_token=DATABRICKS_TOKEN
-    ) as connection:
-        with connection.cursor() as cursor:
-            cursor.execute("SHOW CATALOGS")
-            catalogs = cursor.fetchall()
-            catalogs = [catalog.catalog for catalog in catalogs]
-            # print(catalogs)
-        return catalogs
+def get_data_batches(catalog=None, schema=None, table=None, column=None, resolution=9, bounds=None, column_resolution=None, tiles=None):
+    """Streaming variant of get_data that yields Arrow record batches as they arrive from the warehouse."""
+    if not catalog or not schema or not table or not column:
+        print("No catalog, schema, table, or column provided. Returning empty data.")
+        return
+    
+    stime = dt.datetime.now()
+    rows = 0
+    try:
+        resolution = min([int(column_resolution), resolution])
+        print(f"RESOLUTION: {resolution}")
+        cached, query, query_key, tiles, missing, tile_resolution = plan_data_query(catalog, schema, table, column, resolution, bounds, tiles)
+        cells = []
+        for cached_table in cached:
+            for batch in cached_table.to_batches():
+                rows += batch.num_rows
+                cells.append(cell_ids_to_int(batch.column('h3_cell_id')))
+                yield batch
+        complete = True
+        if query is not None:
+            fresh = []
+            for batch in sqlQueryArrowBatches(query, batch_rows=ARROW_STREAM_BATCH_ROWS):
+                rows += batch.num_rows
+                cells.append(cell_ids_to_int(batch.column('h3_cell_id')))
+                fresh.append(batch)
+                yield batch
+            complete = not fresh or not is_partial_result(pa.Table.from_batches(fresh))
+            if query_key is not None and fresh and complete:
+                tile_cache_store(query_key, missing, tile_resolution, pa.Table.from_batches(fresh))
+        if complete and tiles:
+            record_tile_density(catalog, schema, table, column, resolution, tiles, tile_resolution,
+                                np.concatenate(cells) if cells else np.array([], dtype=np.int64))
+    except Exception as e:
+        print(f"An error occurred in streaming data: {str(e)}")
+    print(f"DATA STREAM TOOK:    {dt.datetime.now() - stime}")
+    print("ROWS:", rows)
+
+# Integer types small enough to be a time field such as pickup_hour. BIGINT and
+# STRING columns are left out, which also keeps H3 cell columns off the list.
+TIME_INTEGER_TYPES = ("TINYINT", "SMALLINT", "INT", "INTEGER")
+TIME_DATE_TYPES = ("DATE", "TIMESTAMP", "TIMESTAMP_NTZ")
+# Buckets dates and timestamps are animated by, as (option suffix, label, SQL template)
+TIME_BUCKETS = [
+    ("hour", "hour of day", "hour({})"),
+    ("weekday", "day of week", "dayofweek({})"),
+    ("day", "day", "date_trunc('DAY', {})"),
+    ("month", "month", "date_trunc('MONTH', {})"),
+]
+
+def get_time_frame_options(catalog, schema, table):
+    """{option value: (label, frame SQL)} for every way the table's columns can drive the time slider.
+
+    Integer columns are used as they are; dates and timestamps are bucketed,
+    since their raw values are nearly all distinct.
+    """
+    options = {}
+    for name, data_type in describe_table_columns(catalog, schema, table).items():
+        if data_type in TIME_INTEGER_TYPES:
+            options[name] = (name, name)
+        elif data_type in TIME_DATE_TYPES:
+            for suffix, label, template in TIME_BUCKETS:
+                if suffix == "hour" and data_type == "DATE":
+                    continue
+                options[f"{name}:{suffix}"] = (f"{name} ({label})", template.format(name))
+    return options
+
+def get_time_columns(catalog, schema, table):
+    """Dropdown options for the time slider."""
+    return [{"label": label, "value": value} for value, (label, _) in get_time_frame_options(catalog, schema, table).items()]
+
+def time_frame_matrix(data):
+    """Pivot (h3_cell_id, frame, count) rows into cells, frame labels and a cells x frames count matrix.
+
+    Frames are the distinct frame values in ascending order.
+    """
+    frames = pc.unique(data.column('frame'))
+    frames = frames.take(pc.array_sort_indices(frames))
+    cells, rows = np.unique(cell_ids_to_int(data.column('h3_cell_id')), return_inverse=True)
+    columns = pc.index_in(data.column('frame'), value_set=frames).to_numpy()
+    matrix = np.zeros((len(cells), len(frames)), dtype=np.float32)
+    np.add.at(matrix, (rows, columns), data.column('count').to_numpy())
+    # Day and month buckets come back as midnight timestamps
+    return cells, [str(frame).removesuffix(" 00:00:00") for frame in frames.to_pylist()], matrix
+
+def get_time_frames(catalog, schema, table, column, frame_sql, resolution, bounds, column_resolution):
+    """Counts per cell and time frame in the viewport, from a single GROUP BY query.
+
+    Returns the time_frame_matrix pivot of the first TIME_MAX_FRAMES frames.
+    Every frame of an animation comes from this one warehouse scan.
+    """
+    stime = dt.datetime.now()
+    resolution = min(int(column_resolution), resolution)
+    family = get_h3_column_family(catalog, schema, table, column)
+    tile_resolution = tile_resolution_for(resolution)
+    tiles = viewport_tiles(bounds, tile_resolution) if bounds else None
+    query = build_time_query(catalog, schema, table, column, resolution, frame_sql, TIME_MAX_FRAMES, tiles, tile_resolution, family)
+    data = sqlQueryArrow(query, share_scope=get_cache_scope(catalog, schema, table))
+    cells, frames, matrix = time_frame_matrix(data)
+    print(f"TIME FRAMES QUERY TOOK:    {dt.datetime.now() - stime}")
+    print(f"CELLS: {len(cells)}, FRAMES: {len(frames)}")
+    return cells, frames, matrix
+
+def time_frames_for_browser(cells, frames, matrix):
+    """Cell ID halves and the cell-major float32 count matrix as base64, with the frame labels."""
+    return {
+        "cells": base64.b64encode(cell_id_halves(cells).tobytes()).decode(),
+        "counts": base64.b64encode(np.ascontiguousarray(matrix, dtype="<f4").tobytes()).decode(),
+        "frames": frames,
+    }
+
+def get_compare_data(catalog, schema, table, column, compare_column, resolution, bounds, column_resolution):
+    """Counts per cell of column (count_a) and compare_column (count_b) in the viewport.
+
+    Both come from one build_compare_query scan. Its result is kept in the
+    tile cache under the column pair, so switching views needs no new query.
+    """
+    stime = dt.datetime.now()
+    compare_resolution = get_h3_columns(catalog, schema, table)[compare_column]
+    resolution = min(int(column_resolution), compare_resolution, resolution)
+    families = [get_h3_column_family(catalog, schema, table, name) for name in (column, compare_column)]
+    tile_resolution = tile_resolution_for(resolution)
+    tiles = viewport_tiles(bounds, tile_resolution)
+    query_key = (f"{catalog}.{schema}.{table}".lower(), f"{column}|{compare_column}".lower(), resolution,
+                 get_cache_scope(catalog, schema, table))
+    cached, missing = tile_cache_lookup(query_key, tiles)
+    print(f"COMPARE TILES: {len(tiles)} at resolution {tile_resolution}, {len(cached)} cached, {len(missing)} to query")
+    tables = list(cached)
+    if missing:
+        query = build_compare_query(catalog, schema, table, (column, compare_column), resolution, missing, tile_resolution, families)
+        fresh = sqlQueryArrow(query, share_scope=query_key[3])
+        # Rows whose other column is outside the viewport add cells outside the tiles
+        inside = np.isin(h3_parent_ids(cell_ids_to_int(fresh.column('h3_cell_id')), tile_resolution), missing)
+        fresh = fresh.filter(pa.array(inside))
+        if not is_partial_result(fresh):
+            tile_cache_store(query_key, missing, tile_resolution, fresh)
+        tables.append(fresh)
+    data = pa.concat_tables(tables)
+    print(f"COMPARE QUERY TOOK:    {dt.datetime.now() - stime}")
+    print("ROWS:", len(data))
+    return data
+
+def compare_cells_for_browser(data, column, compare_column):
+    """Cell ID halves and both float32 count arrays as base64, with the column names."""
+    return {
+        "cells": base64.b64encode(cell_id_halves(cell_ids_to_int(data.column('h3_cell_id'))).tobytes()).decode(),
+        "counts_a": base64.b64encode(data.column('count_a').to_numpy().astype("<f4").tobytes()).decode(),
+        "counts_b": base64.b64encode(data.column('count_b').to_numpy().astype("<f4").tobytes()).decode(),
+        "columns": [column, compare_column],
+    }
+
+def refresh_resolution(bounds, zoom, column_resolution, catalog, schema, table, column):
+    """H3 resolution a refresh of bounds at zoom is drawn at."""
+    if MAP_RENDER_MODE == "tiles":
+        # Tiles use the zoom table so neighbouring tiles always agree on the resolution
+        return min(zoom_to_h3_resolution(zoom), int(column_resolution))
+    return choose_h3_resolution(bounds, zoom, int(column_resolution), catalog, schema, table, column)
+
+# Speculative prefetch. After a refresh, the ring of viewport tiles around it
+# and the view one zoom level in are fetched into the tile cache in the
+# background, so the usual next pan or zoom is a cache hit. Each user has at
+# most one prefetch in flight, and a newer refresh supersedes a queued one.
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "false").lower() == "true"
+PREFETCH_THREADS = int(os.getenv("PREFETCH_THREADS", "2"))
+# Most viewport tiles one prefetch may query
+PREFETCH_MAX_TILES = int(os.getenv("PREFETCH_MAX_TILES", "64"))
+
+prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_THREADS, thread_name_prefix="prefetch")
+prefetch_latest = {}
+prefetch_stats = {"scheduled": 0, "superseded": 0, "deferred": 0, "completed": 0, "failed": 0, "tiles": 0}
+prefetch_lock = threading.Lock()
+
+def zoomed_in_bounds(bounds):
+    """The middle half of bounds in each direction, i.e. the view one zoom level in."""
+    (south, west), (north, east) = bounds
+    lat_pad, lng_pad = (north - south) / 4, (east - west) / 4
+    return [[south + lat_pad, west + lng_pad], [north - lat_pad, east - lng_pad]]
+
+def schedule_prefetch(query, zoom):
+    """Queue a prefetch around a refresh's query, run with a copy of the caller's request for its credentials."""
+    user = get_user_scope()
+    job = object()
+    with prefetch_lock:
+        prefetch_latest[user] = job
+        prefetch_stats["scheduled"] += 1
+    prefetch_pool.submit(flask.copy_current_request_context(prefetch_viewport), query, zoom, user, job)
+
+def prefetch_viewport(query, zoom, user, job):
+    with prefetch_lock:
+        if prefetch_latest.get(user) is not job:
+            prefetch_stats["superseded"] += 1
+            return
+    if get_query_stats()["queued"] > 0:
+        # Users are waiting for warehouse slots, don't add to the line
+        with prefetch_lock:
+            prefetch_stats["deferred"] += 1
+        return
+    try:
+        resolution = min(int(query["column_resolution"]), query["resolution"])
+        tile_resolution = tile_resolution_for(resolution)
+        tiles = set(viewport_tiles(query["bounds"], tile_resolution))
+        ring = {h3.str_to_int(n) for tile in tiles for n in h3.grid_disk(h3.int_to_str(tile), 1)} - tiles
+        ring = sorted(ring)[:PREFETCH_MAX_TILES]
+        if ring:
+            get_data(**dict(query, tiles=ring))
+
+        inner_bounds = zoomed_in_bounds(query["bounds"])
+        inner_resolution = refresh_resolution(inner_bounds, zoom + 1, query["column_resolution"],
+                                              query["catalog"], query["schema"], query["table"], query["column"])
+        inner_tiles = []
+        if inner_resolution != resolution:
+            inner_tiles = viewport_tiles(inner_bounds, tile_resolution_for(inner_resolution))
+            if len(inner_tiles) <= PREFETCH_MAX_TILES:
+                get_data(**dict(query, resolution=inner_resolution, bounds=inner_bounds))
+            else:
+                inner_tiles = []
+        with prefetch_lock:
+            prefetch_stats["completed"] += 1
+            prefetch_stats["tiles"] += len(ring) + len(inner_tiles)
+    except Exception as e:
+        print(f"Prefetch failed: {e}")
+        with prefetch_lock:
+            prefetch_stats["failed"] += 1
+    finally:
+        with prefetch_lock:
+            if prefetch_latest.get(user) is job:
+                del prefetch_latest[user]
+
+def get_prefetch_stats():
+    with prefetch_lock:
+        return dict(prefetch_stats, pending=len(prefetch_latest))
+
+def show_catalogs():
+    catalogs = sqlQueryArrow("SHOW CATALOGS").column('catalog').to_pylist()
+    # print(catalogs)
+    return catalogs
     
+def show_schemas(catalog):
+    schemas = sqlQueryArrow(f"SHOW SCHEMAS IN {catalog}").column('databaseName').to_pylist()
+    print(f"SCHEMAS in {catalog}: {schemas}")
+    return schemas
+
+def show_tables(catalog, schema):
+    tables = sqlQueryArrow(f"SHOW TABLES IN {catalog}.{schema}").column('tableName').to_pylist()
+    print(f"TABLES IN {catalog}.{schema}: {tables}")
+    return tables
+
+def show_columns(catalog, schema, table):
+    columns = sqlQueryArrow(f"SHOW COLUMNS IN {catalog}.{schema}.{table}").column('col_name').to_pylist()
+    print(f"COLUMNS IN {catalog}.{schema}.{table}: {columns}")
+    return columns
+
+column_info_cache = {}
+
+def get_column_info(catalog, schema, table, column):
+    """H3 resolution and table row count for a column, from a single probe query.
+
+    The unfiltered COUNT(*) is answered from Delta file statistics rather than a
+    scan, so it counts the table's rows, not the column's non-null values, and
+    the resolution comes from the first non-null value. Results are
+    cached per table version, so they are only probed again after a write.
+    """
+    scope = get_cache_scope(catalog, schema, table)
+    key = (f"{catalog}.{schema}.{table}".lower(), column.lower(), scope)
+    if key in column_info_cache:
+        return column_info_cache[key]
+    probe = sqlQueryArrow(f"""
+        SELECT (SELECT count(*) FROM {catalog}.{schema}.{table}) as row_count,
+               (SELECT h3_resolution({column}) FROM {catalog}.{schema}.{table} WHERE {column} IS NOT NULL LIMIT 1) as resolution
+    """, share_scope=scope).to_pylist()[0]
+    column_info = {
+        "resolution": probe["resolution"],
+        "row_count": probe["row_count"],
+        "table_version": scope[1] if scope[0] == "version" else None,
+    }
+    if scope[0] == "version":
+        column_info_cache[key] = column_info
+    return column_info
+
+# Per-user catalog -> schema -> table -> columns tree for the dropdowns, loaded
+# with one information_schema query. Entries older than METADATA_REFRESH_SECONDS
+# are served while a background refresh runs; entries older than
+# METADATA_MAX_AGE_SECONDS are reloaded before use.
+METADATA_REFRESH_SECONDS = int(os.getenv("METADATA_REFRESH_SECONDS", "300"))
+METADATA_MAX_AGE_SECONDS = int(os.getenv("METADATA_MAX_AGE_SECONDS", "3600"))
+# Only list columns that can hold H3 cells (BIGINT or STRING)
+METADATA_H3_TYPES_ONLY = os.getenv("METADATA_H3_TYPES_ONLY", "true").lower() == "true"
+# Users whose trees are kept; the least recently used are dropped beyond this
+METADATA_CACHE_MAX_USERS = int(os.getenv("METADATA_CACHE_MAX_USERS", "256"))
+
+metadata_cache = OrderedDict()
+metadata_cache_lock = threading.Lock()
+
+def get_user_identity():
+    """Stable key for the calling user, which unlike get_user_scope survives on-behalf-of token rotation.
+
+    Databricks Apps forwards the user's email and ID with each request; with a
+    static DATABRICKS_TOKEN every request is the same identity anyway.
+    """
+    if not os.getenv("DATABRICKS_TOKEN"):
+        user = flask.request.headers.get("X-Forwarded-Email") or flask.request.headers.get("X-Forwarded-User")
+        if user:
+            return user.lower()
+    return get_user_scope()
+
+def store_metadata_tree(user, tree):
+    """Cache user's tree, dropping expired trees and the least recently used beyond METADATA_CACHE_MAX_USERS."""
+    now = time.time()
+    with metadata_cache_lock:
+        metadata_cache[user] = {"loaded_at": now, "tree": tree, "refreshing": False}
+        metadata_cache.move_to_end(user)
+        for expired in [key for key, entry in metadata_cache.items() if now - entry["loaded_at"] > METADATA_MAX_AGE_SECONDS]:
+            del metadata_cache[expired]
+        while len(metadata_cache) > METADATA_CACHE_MAX_USERS:
+            metadata_cache.popitem(last=False)
+
+def load_metadata_tree(access_token):
+    """Fetch every visible column in one query and nest it as {catalog: {schema: {table: [columns]}}}."""
+    stime = dt.datetime.now()
+    type_filter = "AND lower(full_data_type) IN ('bigint', 'string')" if METADATA_H3_TYPES_ONLY else ""
+    result = sqlQueryArrow(f"""
+        SELECT table_catalog, table_schema, table_name, column_name
+        FROM system.information_schema.columns
+        WHERE table_schema != 'information_schema' {type_filter}
+        ORDER BY table_catalog, table_schema, table_name, ordinal_position
+    """, access_token=access_token)
+    tree = {}
+    for catalog, schema, table, column in zip(*(result.column(i).to_pylist() for i in range(4))):
+        tree.setdefault(catalog, {}).setdefault(schema, {}).setdefault(table, []).append(column)
+    print(f"METADATA PREFETCH TOOK:    {dt.datetime.now() - stime} ({result.num_rows} columns)")
+    return tree
+
+def refresh_metadata_tree(user, access_token):
+    try:
+        store_metadata_tree(user, load_metadata_tree(access_token))
+    except Exception as e:
+        print(f"Error refreshing metadata: {e}")
+        with metadata_cache_lock:
+            if user in metadata_cache:
+                metadata_cache[user]["refreshing"] = False
+
+def get_metadata_tree():
+    """The caller's metadata tree, or None if the bulk query is not available to them."""
+    # The token is only used to run the query; the cache is keyed by who the user is
+    access_token = get_databricks_token()
+    user = get_user_identity()
+    now = time.time()
+    with metadata_cache_lock:
+        entry = metadata_cache.get(user)
+        if entry is not None:
+            metadata_cache.move_to_end(user)
+        start_refresh = (entry is not None and not entry["refreshing"]
+                         and now - entry["loaded_at"] > METADATA_REFRESH_SECONDS
+                         and now - entry["loaded_at"] <= METADATA_MAX_AGE_SECONDS)
+        if start_refresh:
+            entry["refreshing"] = True
+    if start_refresh:
+        threading.Thread(target=refresh_metadata_tree, args=(user, access_token), daemon=True).start()
+    if entry is not None and now - entry["loaded_at"] <= METADATA_MAX_AGE_SECONDS:
+        return entry["tree"]
+    try:
+        tree = load_metadata_tree(access_token)
+    except Exception as e:
+        print(f"Metadata prefetch unavailable, falling back to SHOW commands: {e}")
+        return None
+    store_metadata_tree(user, tree)
+    return tree
+
+def get_catalogs():
+    tree = get_metadata_tree()
+    return sorted(tree) if tree is not None else show_catalogs()
+
 def get_schemas(catalog):
-    DATABRICKS_SERVER_HOSTNAME = get_databricks_server_hostname()
-    DATABRICKS_TOKEN = get_databricks_token()
-    with sql.connect(
-        http_path=f"/sql/1.0/warehouses/{DATABRICKS_WAREHOUSE_ID}",
-        server_hostname=DATABRICKS_SERVER_HOSTNAME,
-        access_token=DATABRICKS_TOKEN
-    ) as connection:
-        with connection.cursor() as cursor:
-            cursor.execute(f"SHOW SCHEMAS IN {catalog}")
-            schemas = cursor.fetchall()
-            schemas = [schema.databaseName for schema in schemas]
-            print(f"SCHEMAS in {catalog}: {schemas}")
-        return schemas
+    tree = get_metadata_tree()
+    return sorted(tree.get(catalog, {})) if tree is not None else show_schemas(catalog)
 
 def get_tables(catalog, schema):
-    DATABRICKS_SERVER_HOSTNAME = get_databricks_server_hostname()
-    DATABRICKS_TOKEN = get_databricks_token()
-    with sql.connect(
-        http_path=f"/sql/1.0/warehouses/{DATABRICKS_WAREHOUSE_ID}",
-        server_hostname=DATABRICKS_SERVER_HOSTNAME,
-        access_token=DATABRICKS_TOKEN
-    ) as connection:
-        with connection.cursor() as cursor: 
-            cursor.execute(f"SHOW TABLES IN {catalog}.{schema}")
-            tables = cursor.fetchall()
-            tables = [table.tableName for table in tables]
-            print(f"TABLES IN {catalog}.{schema}: {tables}")
-        return tables
+    tree = get_metadata_tree()
+    return sorted(tree.get(catalog, {}).get(schema, {})) if tree is not None else show_tables(catalog, schema)
 
 def get_columns(catalog, schema, table):
-    DATABRICKS_SERVER_HOSTNAME = get_databricks_server_hostname()
-    DATABRICKS_TOKEN = get_databricks_token()
-    with sql.connect(
-        http_path=f"/sql/1.0/warehouses/{DATABRICKS_WAREHOUSE_ID}",
-        server_hostname=DATABRICKS_SERVER_HOSTNAME,
-        access_token=DATABRICKS_TOKEN
-    ) as connection:
-        with connection.cursor() as cursor:
-            cursor.execute(f"SHOW COLUMNS IN {catalog}.{schema}.{table}")
-            columns = cursor.fetchall()
-            columns = [col.col_name for col in columns]
-            print(f"COLUMNS IN {catalog}.{schema}.{table}: {columns}")
-        return columns
-
-def style_function(count, septiles):
-    fill_color = '#FFFFFF'  # default white
-    
-    if count >= septiles[6]:
-        fill_color = '#800026'      # dark red
-    elif count >= septiles[5]:
-        fill_color = '#BD0026'      # red
-    elif count >= septiles[4]:
-        fill_color = '#E31A1C'      # light red
-    elif count >= septiles[3]:
-        fill_color = '#FC4E2A'      # orange-red
-    elif count >= septiles[2]:
-        fill_color = '#FD8D3C'      # orange
-    elif count >= septiles[1]:
-        fill_color = '#FEB24C'      # light orange
-    elif count >= septiles[0]:
-        fill_color = '#FED976'      # yellow
-    
-    return {
-        "fillColor": fill_color,
-        "weight": 1,
-        "opacity": 0.9,
-        "color": fill_color,
-        "fillOpacity": 0.7
-    };
-
-def create_legend(septiles):
+    tree = get_metadata_tree()
+    if tree is None:
+        return show_columns(catalog, schema, table)
+    return tree.get(catalog, {}).get(schema, {}).get(table, [])
+
+
+# Fill colors for the seven log-scaled count bins, lightest to darkest
+HEX_COLORS = ['#FED976', '#FEB24C', '#FD8D3C', '#FC4E2A', '#E31A1C', '#BD0026', '#800026']
+# Cells below the lowest break
+HEX_DEFAULT_COLOR = '#FFFFFF'
+HEX_STYLE = {"weight": 1, "opacity": 0.9, "fillOpacity": 0.7}
+# Diverging colors for comparing two columns, from mostly the second to mostly the first
+COMPARE_COLORS = ['#2166AC', '#67A9CF', '#D1E5F0', '#F7F7F7', '#FDDBC7', '#EF8A62', '#B2182B']
+# Color schemes the browser can restyle the map with, without a new query
+COLOR_SCHEMES = [
+    {"label": "Log", "value": "log"},
+    {"label": "Quantile", "value": "quantile"},
+    {"label": "Linear", "value": "linear"},
+    {"label": "Jenks", "value": "jenks"},
+]
+
+# Legend styles, shared with the legend the browser draws when restyling
+LEGEND_STYLE = {
+    "position": "absolute",
+    "top": "10px",
+    "right": "10px",
+    "backgroundColor": "#3A3A3A",
+    "padding": "8px 16px", #"10px",
+    "borderRadius": "4px",
+    "boxShadow": "0 0 10px rgba(0,0,0,0.3)",
+    "zIndex": "1000",
+    "fontFamily": "Helvetica"
+}
+LEGEND_TITLE_STYLE = {"marginBottom": "10px", "fontSize": "14px", "color": "#FFFFFF", "fontFamily": "Helvetica", "fontWeight": "bold"}
+LEGEND_SWATCH_STYLE = {"width": "20px", "height": "20px", "border": "1px solid #000", "display": "inline-block", "marginRight": "8px"}
+LEGEND_LABEL_STYLE = {"fontSize": "12px", "color": "#FFFFFF"}
+LEGEND_ITEM_STYLE = {"marginBottom": "5px"}
+
+# Clientside functions from assets/h3viz.js
+h3viz_map = Namespace("h3viz", "map")
+
+def legend_title(payload):
+    """Counts of mixed-resolution maps are per cell of the finest resolution shown."""
+    if "refine" in payload:
+        # Coarse progressive cells are already counted per cell of the resolution they are refined to
+        return f"Counts per res {payload['refine']['resolution']} cell"
+    resolutions = np.unique((payload["cells"] >> H3_RES_SHIFT) & 0xF)
+    if len(resolutions) > 1:
+        return f"Counts per res {int(resolutions.max())} cell"
+    return "Counts"
+
+def format_break(value):
+    # Densities and per-cell averages can be fractional
+    return f"{int(value)}" if value >= 10 else f"{value:.2g}"
+
+def create_legend(septiles, title="Counts"):
     """Create a legend component for the map"""
-    legend_items = [
-        {"color": "#FED976", "label": f"< {int(septiles[1])}"},
-        {"color": "#FEB24C", "label": f"{int(septiles[1])}-{int(septiles[2])}"},
-        {"color": "#FD8D3C", "label": f"{int(septiles[2])}-{int(septiles[3])}"},
-        {"color": "#FC4E2A", "label": f"{int(septiles[3])}-{int(septiles[4])}"},
-        {"color": "#E31A1C", "label": f"{int(septiles[4])}-{int(septiles[5])}"},
-        {"color": "#BD0026", "label": f"{int(septiles[5])}-{int(septiles[6])}"},
-        {"color": "#800026", "label": f"≥ {int(septiles[6])}"}
-    ]
+    labels = [f"< {format_break(septiles[1])}"]
+    labels += [f"{format_break(septiles[i])}-{format_break(septiles[i + 1])}" for i in range(1, 6)]
+    labels.append(f"≥ {format_break(septiles[6])}")
+    legend_items = [{"color": color, "label": label} for color, label in zip(HEX_COLORS, labels)]
     
     legend_divs = []
     for item in legend_items:
         legend_divs.append(
             html.Div([
-                html.Div(
-                    style={
-                        "backgroundColor": item["color"],
-                        "width": "20px",
-                        "height": "20px",
-                        "border": "1px solid #000",
-                        "display": "inline-block",
-                        "marginRight": "8px"
-                    }
-                ),
-                html.Span(item["label"], style={"fontSize": "12px", "color": "#FFFFFF"})
-            ], style={"marginBottom": "5px"})
+                html.Div(style=dict(LEGEND_SWATCH_STYLE, backgroundColor=item["color"])),
+                html.Span(item["label"], style=LEGEND_LABEL_STYLE)
+            ], style=LEGEND_ITEM_STYLE)
         )
     
     return html.Div([
-        html.Div("Counts",
-                 style={"marginBottom": "10px",
-                        "fontSize": "14px",
-                        "color": "#FFFFFF",
-                        "fontFamily": "Helvetica",
-                        "fontWeight": "bold"}),
+        html.Div(title, style=LEGEND_TITLE_STYLE),
         html.Div(legend_divs)
     ], 
-        style={
-        "position": "absolute",
-        "top": "10px",
-        "right": "10px",
-        "backgroundColor": "#3A3A3A",
-        "padding": "8px 16px", #"10px",
-        "borderRadius": "4px",
-        "boxShadow": "0 0 10px rgba(0,0,0,0.3)",
-        "zIndex": "1000",
-        "fontFamily": "Helvetica"
-    }
+        style=LEGEND_STYLE
     )
 
 def zoom_to_h3_resolution(zoom):
@@ -271,25 +1611,97 @@ def zoom_to_h3_resolution(zoom):
         return 12
     else:
         return 12
-    
-def bounds_to_wkt(bounds):
-    # Input bounds: [southwest, northeast] in (lat, lon)
-    sw = bounds[0]  # [lat, lon]
-    ne = bounds[1]  # [lat, lon]
-
-    # Create polygon corners: lon/lat order
-    polygon_coords = [
-        (sw[1], sw[0]),  # lower left
-        (sw[1], ne[0]),  # upper left
-        (ne[1], ne[0]),  # upper right
-        (ne[1], sw[0]),  # lower right
-        (sw[1], sw[0])   # close polygon
-    ]
 
-    # Create polygon and convert to WKT
-    poly = Polygon(polygon_coords)
-    wkt_string = poly.wkt
-    return wkt_string
+EARTH_RADIUS_KM = 6371.0088
+
+def bounds_area_km2(bounds):
+    """Spherical area of a [southwest, northeast] lat/lng box."""
+    (south, west), (north, east) = bounds
+    width = min(abs(east - west), 360.0)
+    south, north = max(min(south, north), -90.0), min(max(south, north), 90.0)
+    return EARTH_RADIUS_KM ** 2 * math.radians(width) * abs(math.sin(math.radians(north)) - math.sin(math.radians(south)))
+
+def estimate_viewport_cells(bounds, resolution):
+    """Number of H3 cells at resolution that cover bounds, from the average cell area."""
+    return bounds_area_km2(bounds) / h3.average_hexagon_area(resolution, unit="km^2")
+
+# Cells that held data per viewport tile, keyed by (table, column, resolution,
+# tile). Tiles are always queried whole, and a cell has at most 7 children per
+# resolution, so a tile's count bounds how many cells it can fill at any finer
+# resolution. Counts of one area say nothing about another, so tiles never
+# queried count as full.
+DENSITY_STATS_MAX_TILES = TILE_CACHE_MAX_TILES
+# Levels whose tiles would number more than this in the viewport are not looked up
+DENSITY_MAX_LOOKUP_TILES = 4096
+density_stats = OrderedDict()
+density_levels = {}
+density_stats_lock = threading.Lock()
+
+def record_tile_density(catalog, schema, table, column, resolution, tiles, tile_resolution, cells):
+    """Remember how many of cells, at resolution, fall in each of the fully fetched tiles."""
+    table_key = (f"{catalog}.{schema}.{table}".lower(), column.lower())
+    parents, counts = np.unique(h3_parent_ids(cells, tile_resolution), return_counts=True)
+    occupied = dict(zip(parents.tolist(), counts.tolist()))
+    with density_stats_lock:
+        density_levels.setdefault(table_key, set()).add(resolution)
+        for tile in tiles:
+            key = table_key + (resolution, tile)
+            density_stats[key] = occupied.get(tile, 0)
+            density_stats.move_to_end(key)
+        while len(density_stats) > DENSITY_STATS_MAX_TILES:
+            density_stats.popitem(last=False)
+
+def observed_tile_cells(bounds, catalog, schema, table, column):
+    """{resolution: cells with data in the tiles covering bounds} for each resolution queried before.
+
+    Tiles without a count are taken as full.
+    """
+    if not DENSITY_AWARE_RESOLUTION or not column or not bounds:
+        return {}
+    table_key = (f"{catalog}.{schema}.{table}".lower(), column.lower())
+    with density_stats_lock:
+        levels = sorted(density_levels.get(table_key, ()))
+    observed = {}
+    for resolution in levels:
+        tile_resolution = tile_resolution_for(resolution)
+        if estimate_viewport_cells(bounds, tile_resolution) > DENSITY_MAX_LOOKUP_TILES:
+            continue
+        tiles = viewport_tiles(bounds, tile_resolution)
+        full = 7 ** (resolution - tile_resolution)
+        with density_stats_lock:
+            observed[resolution] = sum(density_stats.get(table_key + (resolution, tile), full) for tile in tiles)
+    return observed
+
+def estimate_data_cells(bounds, resolution, observed):
+    """Cells drawn for bounds at resolution: the viewport's cell count, lowered by
+    the bound each coarser observed_tile_cells level puts on it."""
+    cells = estimate_viewport_cells(bounds, resolution)
+    for observed_resolution, occupied in observed.items():
+        if observed_resolution <= resolution:
+            cells = min(cells, occupied * 7 ** (resolution - observed_resolution))
+    return cells
+
+def choose_h3_resolution(bounds, zoom, max_resolution, catalog=None, schema=None, table=None, column=None):
+    """Finest resolution whose estimated cell count for bounds fits RENDER_CELL_BUDGET.
+
+    Hexagons smaller than H3_MIN_HEX_PIXELS on screen are never chosen, so
+    sparse data does not drop to invisible cells when zoomed out.
+    """
+    if not bounds or RENDER_CELL_BUDGET <= 0 or zoom is None:
+        return min(zoom_to_h3_resolution(zoom or 0), max_resolution)
+    center_lat = (bounds[0][0] + bounds[1][0]) / 2
+    meters_per_pixel = 156543.03392 * math.cos(math.radians(center_lat)) / 2 ** zoom
+    resolution = max_resolution
+    while resolution > 0 and h3.average_hexagon_edge_length(resolution, unit="m") * 2 < H3_MIN_HEX_PIXELS * meters_per_pixel:
+        resolution -= 1
+    observed = observed_tile_cells(bounds, catalog, schema, table, column)
+    while resolution > 0:
+        cells = estimate_data_cells(bounds, resolution, observed)
+        if cells <= RENDER_CELL_BUDGET:
+            break
+        resolution -= 1
+    print(f"CHOSEN RESOLUTION: {resolution} (~{int(estimate_data_cells(bounds, resolution, observed)):,} cells in view)")
+    return resolution
 
 def create_log_color_scale(data, n_colors=7):
     """Create log-scaled color breaks for mapping"""
@@ -304,50 +1716,205 @@ def create_log_color_scale(data, n_colors=7):
     
     return breaks 
 
-def create_leaflet_map(map_data, zoom=None, center=None):
-    """Create a Leaflet map component with the hexagon data"""
-    print("creating leaflet map")
+@lru_cache(maxsize=H3_BOUNDARY_CACHE_SIZE)
+def cell_boundary(cell):
+    """GeoJSON (lng, lat) exterior ring of an integer H3 cell."""
+    ring = [[lng, lat] for lat, lng in h3.cell_to_boundary(h3.int_to_str(cell))]
+    ring.append(ring[0])
+    return ring
 
-    septiles = create_log_color_scale(map_data['count']) if len(map_data) > 0 else range(1, 8)
-    print('septiles', [int(x) for x in septiles])
-    legend = create_legend(septiles)
-
-    hex_centers_lats = []
-    hex_centers_lngs = []
-    hex_boundaries_polygons = []
-    hex_boundaries_geojson = {
-        "type": "FeatureCollection",
-        "features": []
+def cell_ids_to_int(cell_ids):
+    """Convert an Arrow column of H3 cells (BIGINT or hex STRING) to an int64 array."""
+    if pa.types.is_integer(cell_ids.type):
+        return cell_ids.to_numpy(zero_copy_only=False).astype(np.int64, copy=False)
+    return np.array([int(cell, 16) for cell in cell_ids.to_pylist()], dtype=np.int64)
+
+def build_hexagon_payload(map_data, breaks=None, with_rings=True):
+    """Build the per-cell boundaries, counts and color bins for the map in one pass.
+
+    map_data is an Arrow table or an iterable of Arrow record batches with
+    h3_cell_id and count columns, plus hex_boundary when the warehouse drew the
+    boundaries. Each boundary is parsed or looked up once and colors are
+    assigned for all cells at once with np.digitize against the log color breaks.
+    With with_rings=False only cell IDs are returned, for drawing in the browser.
+    """
+    rings = [] if with_rings else None
+    cells = []
+    counts = []
+    batches = map_data.to_batches() if isinstance(map_data, pa.Table) else map_data
+    for batch in batches:
+        batch_cells = cell_ids_to_int(batch.column('h3_cell_id'))
+        cells.append(batch_cells)
+        counts.append(batch.column('count').to_numpy())
+        if not with_rings:
+            continue
+        if 'hex_boundary' in batch.schema.names:
+            rings.extend(
+                json.loads(boundary)['coordinates'][0]
+                for boundary in batch.column('hex_boundary').to_pylist()
+            )
+        else:
+            rings.extend(cell_boundary(cell) for cell in batch_cells.tolist())
+    cells = np.concatenate(cells) if cells else np.array([], dtype=np.int64)
+    counts = np.concatenate(counts) if counts else np.array([], dtype=np.int64)
+
+    if breaks is None:
+        breaks = create_log_color_scale(counts) if len(counts) > 0 else range(1, 8)
+    # 0 is below the lowest break, 1-7 index into HEX_COLORS
+    bins = np.digitize(counts, np.asarray(breaks)[:len(HEX_COLORS)]).astype(np.uint8)
+
+    # rings are GeoJSON (lng, lat) exterior rings, one per cell
+    return {"cells": cells, "rings": rings, "counts": counts, "bins": bins, "breaks": breaks}
+
+def hexagon_layer_props(payload):
+    """GeoJSON data and hideout for the hexagon layer; data is None when the browser draws boundaries."""
+    if payload["rings"] is None:
+        # Boundaries are drawn by the hex-cells clientside callback
+        data = None
+    else:
+        features = [
+            {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [ring]}, "properties": {"count": count}}
+            for ring, count in zip(payload["rings"], payload["counts"].tolist())
+        ]
+        data = {"type": "FeatureCollection", "features": features}
+        if "refine" in payload:
+            # Tiles and generation let mergeRefinedCells swap coarse cells for refined ones
+            for feature, tile in zip(features, payload["refine"]["tiles"]):
+                feature["properties"]["tile"] = tile
+            data["generation"] = payload["refine"]["generation"]
+    hideout = {
+        "classes": [float(b) for b in payload["breaks"][:len(HEX_COLORS)]],
+        "colorscale": HEX_COLORS,
+        # Base colors and legend title for restyling in the browser
+        "palette": HEX_COLORS,
+        "divergingPalette": COMPARE_COLORS,
+        "legendTitle": "Count per km²" if MAP_RENDER_MODE == "tiles" else legend_title(payload),
+        "defaultColor": HEX_DEFAULT_COLOR,
+        "colorProp": "count",
+        "style": HEX_STYLE,
     }
-    dlPolygons = []
-    for i in range(len(map_data)):
-        hex_boundaries_polygon = [[coord[1], coord[0]] for coord in json.loads(map_data.iloc[i]['hex_boundary'])['coordinates'][0]]
-        hex_boundaries_polygons.append(hex_boundaries_polygon)
-        
-        hex_boundary_element = {'type': 'Feature'}
-        hex_boundary_element['geometry'] = json.loads(map_data.iloc[i]['hex_boundary'])
-        hex_centers_lats.append(json.loads(map_data.iloc[i]['hex_boundary'])['coordinates'][0][0][1])
-        hex_centers_lngs.append(json.loads(map_data.iloc[i]['hex_boundary'])['coordinates'][0][0][0])
-        hex_boundary_element['properties'] = {
-            'count': map_data.iloc[i]['count'].item(),
-            'color': style_function(map_data.iloc[i]['count'].item(), septiles)
+    return data, hideout
+
+def cell_id_halves(cells):
+    """(high, low) little-endian uint32 halves of int64 cell IDs, since BIGINT cells don't fit in a JavaScript number."""
+    cells = np.asarray(cells, dtype=np.int64).view(np.uint64)
+    halves = np.empty((len(cells), 2), dtype="<u4")
+    halves[:, 0] = cells >> np.uint64(32)
+    halves[:, 1] = cells & np.uint64(0xFFFFFFFF)
+    return halves
+
+def hex_cells_for_browser(payload):
+    """Cell IDs and counts for drawing in the browser, as hex strings or base64 typed arrays (HEX_CELL_TRANSPORT)."""
+    if HEX_CELL_TRANSPORT == "binary":
+        hex_cells = {
+            "encoding": "base64",
+            "cells": base64.b64encode(cell_id_halves(payload["cells"]).tobytes()).decode(),
+            "counts": base64.b64encode(np.asarray(payload["counts"], dtype="<f4").tobytes()).decode(),
         }
-        hex_boundaries_geojson['features'].append(hex_boundary_element)
-
-        style = style_function(map_data.iloc[i]['count'].item(), septiles)
-        dlPolygons.append(
-        {
-            "positions": hex_boundaries_polygon,
-            "fillColor": style['fillColor'],
-            "color": style['color'],
-            "weight": style['weight'],
-            "opacity": style['opacity'],
-            "fillOpacity": style['fillOpacity']
-        })
-        # print(dlPolygons)
+    else:
+        hex_cells = {
+            "cells": [format(cell, "x") for cell in payload["cells"].tolist()],
+            "counts": payload["counts"].tolist(),
+        }
+    if "refine" in payload:
+        hex_cells.update(payload["refine"])
+    return hex_cells
+
+def create_hexagon_layer(payload):
+    """Create a single GeoJSON layer for all hexagons, colored in the browser from the count property."""
+    data, hideout = hexagon_layer_props(payload)
+    return dl.GeoJSON(
+        data=data,
+        style=h3viz_map("styleHexagon"),
+        hideout=hideout,
+        id="hex-layer",
+    )
+
+def create_polygon_components(payload):
+    """Create one dl.Polygon per hexagon with its color resolved on the server."""
+    palette = [HEX_DEFAULT_COLOR] + HEX_COLORS
+    return [
+        dl.Polygon(
+            positions=[[lat, lng] for lng, lat in ring],
+            fillColor=palette[b],
+            color=palette[b],
+            **HEX_STYLE
+        )
+        for ring, b in zip(payload["rings"], payload["bins"].tolist())
+    ]
+
+def cell_density(map_data):
+    """Replace counts with counts per km², so cells of any resolution share one color scale."""
+    if len(map_data) == 0:
+        return map_data
+    cells = cell_ids_to_int(map_data.column('h3_cell_id'))
+    areas = np.array([h3.average_hexagon_area(r, unit="km^2") for r in range(16)])
+    density = map_data.column('count').to_numpy().astype(np.float64) / areas[(cells >> H3_RES_SHIFT) & 0xF]
+    return map_data.set_column(map_data.schema.get_field_index('count'), 'count', pa.array(density))
+
+def xyz_tile_bounds(z, x, y):
+    """[southwest, northeast] lat/lng bounds of a Web Mercator XYZ tile."""
+    n = 2 ** z
+    west, east = x / n * 360 - 180, (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return [[south, west], [north, east]]
+
+def xyz_tile_cells(catalog, schema, table, column, resolution, column_resolution, z, x, y):
+    """Cells whose centers fall in an XYZ tile and their counts per km².
+
+    Each cell belongs to exactly one tile, so the browser can draw every
+    tile's hexagons in full without duplicates at the tile edges.
+    """
+    bounds = xyz_tile_bounds(z, x, y)
+    data = fetch_data(catalog, schema, table, column, resolution=resolution, bounds=bounds, column_resolution=column_resolution, partial_ok=False)
+    if len(data) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+    data = cell_density(data)
+    cells = cell_ids_to_int(data.column('h3_cell_id'))
+    (south, west), (north, east) = bounds
+    centers = np.array([h3.cell_to_latlng(h3.int_to_str(cell)) for cell in cells.tolist()])
+    inside = (centers[:, 0] >= south) & (centers[:, 0] < north) & (centers[:, 1] >= west) & (centers[:, 1] < east)
+    return cells[inside], data.column('count').to_numpy()[inside]
+
+def encode_cells_binary(cells, values):
+    """Little-endian uint32 cell count, then (high, low) uint32 halves of each cell ID, then float32 values."""
+    return np.array([len(cells)], dtype="<u4").tobytes() + cell_id_halves(cells).tobytes() + np.asarray(values, dtype="<f4").tobytes()
 
-    center_lat = sum(hex_centers_lats[:10]) / len(hex_centers_lats[:10]) if center is None else center['lat']
-    center_lng = sum(hex_centers_lngs[:10]) / len(hex_centers_lngs[:10]) if center is None else center['lng']
+def create_leaflet_map(map_data, zoom=None, center=None, refine_queue=None):
+    """Create a Leaflet map component with the hexagon data.
+
+    map_data is an Arrow table or an iterable of Arrow record batches with
+    h3_cell_id and count columns (see build_hexagon_payload). Also returns the
+    cell IDs for the browser when BOUNDARY_MODE=client. With a refine_queue
+    from start_progressive_refresh, each cell is tagged with its tile.
+    """
+    print("creating leaflet map")
+
+    client_boundaries = BOUNDARY_MODE == "client" and MAP_RENDER_MODE == "geojson"
+    if MAP_RENDER_MODE == "tiles":
+        # Only the color breaks are needed here, the browser fetches the cells tile by tile
+        payload = build_hexagon_payload(cell_density(map_data), with_rings=False)
+        legend = create_legend(payload["breaks"], "Count per km²")
+    else:
+        payload = build_hexagon_payload(map_data, with_rings=not client_boundaries)
+        if refine_queue:
+            resolution = refine_queue["query"]["resolution"]
+            tiles = h3_parent_ids(payload["cells"], tile_resolution_for(resolution))
+            payload["refine"] = {
+                "generation": refine_queue["generation"],
+                "resolution": resolution,
+                "tiles": [format(tile, "x") for tile in tiles.tolist()],
+            }
+        legend = create_legend(payload["breaks"], legend_title(payload))
+    septiles = payload["breaks"]
+    print('septiles', [int(x) for x in septiles])
+
+    hex_centers = [h3.cell_to_latlng(h3.int_to_str(cell)) for cell in payload["cells"][:10].tolist()]
+    hex_centers_lats = [lat for lat, lng in hex_centers]
+    hex_centers_lngs = [lng for lat, lng in hex_centers]
+    center_lat = sum(hex_centers_lats) / len(hex_centers_lats) if center is None else center['lat']
+    center_lng = sum(hex_centers_lngs) / len(hex_centers_lngs) if center is None else center['lng']
     zoom = zoom if zoom is not None else 11
     print(f"center_lat: {center_lat}, center_lng: {center_lng}")
 
@@ -357,26 +1924,120 @@ def create_leaflet_map(map_data, zoom=None, center=None):
     children = [
         dl.TileLayer(url=tile_layer_url, attribution='© Mapbox © OpenStreetMap')
     ]
-    for dlP in dlPolygons:
-        children.append(dl.Polygon(**dlP))
+    if MAP_RENDER_MODE == "polygons":
+        children.extend(create_polygon_components(payload))
+    else:
+        children.append(create_hexagon_layer(payload))
     
     map_component = dl.Map(
         children,
         trackViewport=True,
+        preferCanvas=True,
         center=[center_lat, center_lng], 
         zoom=zoom, 
         style={"width": "100%", "height": "100vh"},
         id="map-container"
     )
     
-    return map_component, legend
+    hex_cells = hex_cells_for_browser(payload) if client_boundaries else None
+
+    return map_component, legend, hex_cells
+
+def cap_render_cells(data, max_cells, resolution, min_resolution=0):
+    """Roll the sparsest cells up to coarser parents until at most max_cells remain.
+
+    data has h3_cell_id and count columns, with counts given per resolution
+    cell (coarser cells hold their total divided by 7 per level, as in
+    merge_progressive_data). Each pass groups the cells at or finer than a
+    level under their parents and merges the groups with the lowest peak
+    count first, so dense cells stay at full resolution and every count is
+    still covered. Cells are never rolled up past min_resolution, so the
+    result may stay above max_cells. Returns the mixed-resolution table in the
+    same units.
+    """
+    if max_cells <= 0 or len(data) <= max_cells:
+        return data
+    cells = cell_ids_to_int(data.column('h3_cell_id'))
+    resolutions = (cells >> H3_RES_SHIFT) & 0xF
+    totals = data.column('count').to_numpy().astype(np.float64) * 7.0 ** (resolution - resolutions)
+    for level in range(int(resolutions.max()), min_resolution, -1):
+        if len(cells) <= max_cells:
+            break
+        fine = np.flatnonzero(resolutions >= level)
+        parents, inverse, sizes = np.unique(h3_parent_ids(cells[fine], level - 1), return_inverse=True, return_counts=True)
+        peaks = np.zeros(len(parents))
+        np.maximum.at(peaks, inverse, totals[fine] / 7.0 ** (resolution - resolutions[fine]))
+        order = np.argsort(peaks, kind="stable")
+        # Merging a group of n cells into its parent saves n - 1 cells
+        saved = np.cumsum(sizes[order] - 1)
+        merged = np.zeros(len(parents), dtype=bool)
+        merged[order[:np.searchsorted(saved, len(cells) - max_cells) + 1]] = True
+        rolled = merged[inverse]
+        keep = np.ones(len(cells), dtype=bool)
+        keep[fine[rolled]] = False
+        parent_totals = np.bincount(inverse[rolled], weights=totals[fine[rolled]], minlength=len(parents))[merged]
+        cells = np.concatenate([cells[keep], parents[merged]])
+        totals = np.concatenate([totals[keep], parent_totals])
+        resolutions = np.concatenate([resolutions[keep], np.full(merged.sum(), level - 1, dtype=resolutions.dtype)])
+    counts = totals / 7.0 ** (resolution - resolutions)
+    order = np.argsort(-counts, kind="stable")
+    print(f"CAPPED: {len(data)} cells to {len(cells)} at resolutions {int(resolutions.min())}-{int(resolutions.max())}")
+    return pa.table({"h3_cell_id": pa.array(cells[order]), "count": pa.array(counts[order])})
+
+def merge_progressive_data(coarse_data, fine_data, refined_tiles, tile_resolution, resolution_gap):
+    """Fine cells for the refined tiles plus coarse cells everywhere else.
+
+    Coarse counts are divided by the number of fine cells they cover (7 per
+    resolution), so both kinds of cells share one color scale.
+    """
+    tables = []
+    if len(fine_data) > 0:
+        tables.append(fine_data.set_column(
+            fine_data.schema.get_field_index('count'), 'count',
+            fine_data.column('count').cast(pa.float64())))
+    if len(coarse_data) > 0:
+        coarse_cells = cell_ids_to_int(coarse_data.column('h3_cell_id'))
+        unrefined = ~np.isin(h3_parent_ids(coarse_cells, tile_resolution), np.array(refined_tiles, dtype=np.int64))
+        coarse_data = coarse_data.filter(pa.array(unrefined))
+        coarse_counts = coarse_data.column('count').to_numpy() / 7 ** resolution_gap
+        tables.append(coarse_data.set_column(
+            coarse_data.schema.get_field_index('count'), 'count', pa.array(coarse_counts, type=pa.float64())))
+    if not tables:
+        return []
+    columns = [name for name in tables[0].column_names if all(name in t.column_names for t in tables)]
+    return pa.concat_tables([t.select(columns) for t in tables])
+
+def start_progressive_refresh(query, center, generation):
+    """Fetch the coarse map for a refresh and queue its full-resolution tiles for refine_map.
+
+    Returns (coarse map data, refine queue).
+    """
+    resolution = min(int(query["column_resolution"]), query["resolution"])
+    tile_resolution = tile_resolution_for(resolution)
+    coarse_resolution = max(resolution - PROGRESSIVE_COARSE_OFFSET, tile_resolution)
+    coarse_data = get_data(**dict(query, resolution=coarse_resolution))
+    tiles = viewport_tiles(query["bounds"], tile_resolution)
+    tile_centers = [h3.cell_to_latlng(h3.int_to_str(tile)) for tile in tiles]
+    order = sorted(range(len(tiles)), key=lambda i: (tile_centers[i][0] - center['lat']) ** 2 + (tile_centers[i][1] - center['lng']) ** 2)
+    tiles = [tiles[i] for i in order]
+    queue = {
+        "generation": generation,
+        "query": dict(query, resolution=resolution),
+        "tile_count": len(tiles),
+        # Tiles as hex strings to survive the round trip through the browser
+        "pending": [format(tile, "x") for tile in tiles],
+    }
+    map_data = merge_progressive_data(coarse_data, [], [], tile_resolution, resolution - coarse_resolution)
+    if len(map_data) > 0:
+        # Each coarse cell must stay inside one tile so refine_map can replace it
+        map_data = cap_render_cells(map_data, MAX_RENDER_CELLS, resolution, min_resolution=tile_resolution)
+    return map_data, queue
 
 # Get initial data
 print("getting data")
-load_defaults = True
 
 map_data = get_data(catalog=None, schema=None, table=None, column=None, bounds=None, resolution=8)
-leaflet_map, legend = create_leaflet_map(map_data, zoom=11, center={'lat': 40.7128, 'lng': -74.0060})
+leaflet_map, legend, hex_cells = create_leaflet_map(map_data, zoom=11, center={'lat': 40.7128, 'lng': -74.0060})
 
 app.layout = html.Div(
     [
@@ -477,7 +2138,13 @@ app.layout = html.Div(
                                 "marginTop": "20px",
                                 "opacity": "0.6"
                             }
-                        )
+                        ),
+                        dcc.Checklist(
+                            id="auto-refresh",
+                            options=[{"label": " Auto refresh", "value": "auto"}],
+                            value=[],
+                            style={"color": "#FFFFFF", "fontFamily": "Helvetica", "fontSize": "12px", "marginTop": "4px"}
+                        ),
                     ],
                     style={"display": "inline-block", "marginRight": "0px", "float": "right"}
                 ),
@@ -493,9 +2160,98 @@ app.layout = html.Div(
         dcc.Loading(
             children=[
                 html.Div(id="map-container", children=leaflet_map),
-                html.Div(id="legend-container", children=legend)
+                html.Div(id="legend-container", children=legend),
+                html.Div(
+                    [
+                        html.Label("Colors:", style=LEGEND_LABEL_STYLE),
+                        dcc.Dropdown(
+                            id="color-scheme",
+                            options=COLOR_SCHEMES,
+                            value="log",
+                            clearable=False,
+                            style={"width": "140px", "fontFamily": "Helvetica", "fontSize": "12px", "color": "#3A3A3A", "marginBottom": "8px"}
+                        ),
+                        html.Label("Bins:", style=LEGEND_LABEL_STYLE),
+                        dcc.Slider(id="bin-count", min=3, max=9, step=1, value=len(HEX_COLORS), marks=None,
+                                   tooltip={"placement": "bottom"}),
+                        html.Label("Opacity:", style=LEGEND_LABEL_STYLE),
+                        dcc.Slider(id="fill-opacity", min=0.1, max=1, step=0.1, value=HEX_STYLE["fillOpacity"], marks=None,
+                                   tooltip={"placement": "bottom"}),
+                    ],
+                    id="style-controls",
+                    # Restyling needs the browser-styled GeoJSON layer
+                    style=dict(LEGEND_STYLE, top=None, right=None, bottom="30px", left="10px", width="180px",
+                               display="none" if MAP_RENDER_MODE == "polygons" else "block")
+                ),
+                html.Div(
+                    [
+                        html.Label("Time:", style=LEGEND_LABEL_STYLE),
+                        dcc.Dropdown(
+                            id="time-column",
+                            placeholder="No animation",
+                            style={"width": "200px", "fontFamily": "Helvetica", "fontSize": "12px", "color": "#3A3A3A", "marginBottom": "8px"}
+                        ),
+                        dbc.Button("Play", id="time-play", size="sm", style={"fontFamily": "Helvetica", "fontSize": "12px", "marginRight": "8px"}),
+                        html.Span(id="time-frame-label", style=LEGEND_LABEL_STYLE),
+                        dcc.Slider(id="time-frame", min=0, max=0, step=1, value=0, marks=None, updatemode="drag"),
+                        dcc.Interval(id="time-interval", interval=TIME_FRAME_INTERVAL_MS, disabled=True),
+                    ],
+                    id="time-controls",
+                    # Frames are drawn by the browser-styled GeoJSON layer
+                    style=dict(LEGEND_STYLE, top=None, right=None, bottom="30px", left="220px", width="260px",
+                               display="block" if MAP_RENDER_MODE == "geojson" else "none")
+                ),
+                html.Div(
+                    [
+                        html.Label("Compare with:", style=LEGEND_LABEL_STYLE),
+                        dcc.Dropdown(
+                            id="compare-column",
+                            placeholder="No comparison",
+                            style={"width": "200px", "fontFamily": "Helvetica", "fontSize": "12px", "color": "#3A3A3A", "marginBottom": "8px"}
+                        ),
+                        dcc.RadioItems(
+                            id="compare-view",
+                            options=[
+                                {"label": " Difference", "value": "diff"},
+                                {"label": " Ratio", "value": "ratio"},
+                                {"label": " Swipe", "value": "swipe"},
+                            ],
+                            value="diff",
+                            inline=True,
+                            labelStyle={"marginRight": "8px"},
+                            style=LEGEND_LABEL_STYLE,
+                        ),
+                        dcc.Slider(id="compare-swipe", min=0, max=1, step=0.01, value=0.5, marks=None, updatemode="drag"),
+                    ],
+                    id="compare-controls",
+                    # The comparison is drawn by the browser-styled GeoJSON layer
+                    style=dict(LEGEND_STYLE, top=None, right=None, bottom="30px", left="510px", width="260px",
+                               display="block" if MAP_RENDER_MODE == "geojson" else "none")
+                ),
+                dcc.Store(id="legend-style", data={
+                    "legend": LEGEND_STYLE,
+                    "title": LEGEND_TITLE_STYLE,
+                    "swatch": LEGEND_SWATCH_STYLE,
+                    "label": LEGEND_LABEL_STYLE,
+                    "item": LEGEND_ITEM_STYLE,
+                }),
+                dcc.Store(id="hex-cells", data=hex_cells),
+                dcc.Store(id="column-info"),
+                dcc.Store(id="refine-queue"),
+                dcc.Store(id="refined-cells"),
+                dcc.Store(id="tile-source"),
+                dcc.Store(id="time-frames"),
+                dcc.Store(id="compare-cells"),
+                # In memory, so a reload or a duplicated tab starts a new session with its own click count
+                dcc.Store(id="session-id"),
+                # Per-session view state, kept in the browser so any worker can serve the next callback
+                dcc.Store(id="view-state", data={"load_defaults": True}),
+                dcc.Store(id="auto-refresh-config", data={"debounce_ms": AUTO_REFRESH_DEBOUNCE_MS}),
+                dcc.Store(id="auto-refresh-status"),
             ],
             id='loading-map',
+            # Progressive refinement updates the layer in place without the overlay
+            target_components={"map-container": "children"},
             type='default',
             color='#FFFFFF',
             overlay_style={"visibility":"visible", "filter": "blur(3px)"},
@@ -508,7 +2264,11 @@ app.layout = html.Div(
 # Add callback for refresh button and initial load
 @app.callback(
     [Output('map-container', 'children'),
-     Output('legend-container', 'children')],
+     Output('legend-container', 'children'),
+     Output('hex-cells', 'data'),
+     Output('refine-queue', 'data'),
+     Output('tile-source', 'data'),
+     Output('view-state', 'data')],
     Input('refresh-button', 'n_clicks'),
     [State("map-container", "center"),
      State("map-container", "zoom"),
@@ -517,44 +2277,392 @@ app.layout = html.Div(
      State("schema-dropdown", "value"),
      State("table-dropdown", "value"),
      State("column-dropdown", "value"),
-     State("column-description", "children")
+     State("column-info", "data"),
+     State("session-id", "data"),
+     State("view-state", "data"),
+     State("time-column", "value"),
+     State("compare-column", "value")
      ],
      prevent_initial_call=True
 )
-def update_map_and_legend(n_clicks, center, zoom, bounds, catalog, schema, table, column, column_description):
+def update_map_and_legend(n_clicks, center, zoom, bounds, catalog, schema, table, column, column_info, session_id, view_state, time_column, compare_column):
     if n_clicks is None:
         # Initial load - return the pre-created map and legend
         print("Initial map load")
-        return leaflet_map, legend
+        return leaflet_map, legend, hex_cells, None, None, no_update
     else:
         # Refresh button clicked
         print(f"Refreshing map and data (click #{n_clicks})")
 
-        # Update global variables
-        global global_center
-        global global_zoom
-        global global_bounds
-        global_center = center if center is not None else global_center
-        global_zoom = zoom if zoom is not None else global_zoom
-        global_bounds = bounds if bounds is not None else global_bounds
-
-        column_resolution = column_description.split(";")[0].split(":")[1].strip()
-        column_count = column_description.split(";")[1].split(":")[1].strip()
-        print(f"Center: {center}, Zoom: {zoom}, Bounds: {bounds}, Column Resolution: {column_resolution}, Column Count: {column_count}")
-        if isinstance(global_center, list):
-            global_center = {'lat': global_center[0], 'lng': global_center[1]}
-        print(f"Global Center: {global_center}, Global Zoom: {global_zoom}, Global Bounds: {global_bounds}")
-
-        resolution = zoom_to_h3_resolution(global_zoom)
-
-        # Fetch new data
-        new_map_data = get_data(catalog=catalog, schema=schema, table=table, column=column, bounds=global_bounds, resolution=resolution, column_resolution=column_resolution)
-        
-        # Create new map and legend
-        new_leaflet_map, new_legend = create_leaflet_map(new_map_data, zoom=global_zoom, center=global_center)
+        # Fall back to this session's last refreshed view for anything the map didn't report
+        view_state = dict(view_state or {})
+        center = center if center is not None else view_state.get("center")
+        zoom = zoom if zoom is not None else view_state.get("zoom")
+        bounds = bounds if bounds is not None else view_state.get("bounds")
+
+        column_resolution = column_info["resolution"]
+        table_rows = column_info["row_count"]
+        if isinstance(center, list):
+            center = {'lat': center[0], 'lng': center[1]}
+        print(f"Center: {center}, Zoom: {zoom}, Bounds: {bounds}, Column Resolution: {column_resolution}, Table Rows: {table_rows}")
+        resolution = refresh_resolution(bounds, zoom, column_resolution, catalog, schema, table, column)
+        view_state.update(center=center, zoom=zoom, bounds=bounds, resolution=resolution)
+
+        query = dict(catalog=catalog, schema=schema, table=table, column=column, bounds=bounds, resolution=resolution, column_resolution=column_resolution)
+        refine_queue = None
+        with session_queries(session_id, n_clicks):
+            # Time frames and comparisons replace the layer once loaded, so refined tiles must not overwrite it
+            if PROGRESSIVE_REFRESH and MAP_RENDER_MODE == "geojson" and bounds and not time_column and not compare_column:
+                # Draw a coarse map now and let refine_map fill in full-resolution tiles
+                new_map_data, refine_queue = start_progressive_refresh(query, center, n_clicks)
+            else:
+                # Fetch new data, streaming Arrow batches straight into the map builder if configured.
+                # The cell cap needs the whole result, so it always fetches at once.
+                if MAX_RENDER_CELLS > 0:
+                    new_map_data = get_data(**query, max_cells=MAX_RENDER_CELLS)
+                elif ARROW_STREAM_BATCH_ROWS > 0:
+                    new_map_data = get_data_batches(**query)
+                else:
+                    new_map_data = get_data(**query)
+            
+            # Create new map and legend
+            new_leaflet_map, new_legend, new_hex_cells = create_leaflet_map(new_map_data, zoom=zoom, center=center, refine_queue=refine_queue)
+        if is_superseded(session_id, n_clicks):
+            print(f"Refresh #{n_clicks} superseded by a newer one")
+            raise PreventUpdate
         
+        tile_source = None
+        if MAP_RENDER_MODE == "tiles":
+            # The generation makes the browser drop tiles it cached before this refresh
+            # The column's resolution travels in the URL, so tile requests don't probe the column again
+            tile_source = {"url": f"/tiles/{catalog}.{schema}.{table}/{column}/{int(column_resolution)}", "generation": n_clicks}
+
+        if PREFETCH_ENABLED and bounds:
+            schedule_prefetch(query, zoom)
+
         print("Map refreshed successfully!")
-        return new_leaflet_map, new_legend
+        return new_leaflet_map, new_legend, new_hex_cells, refine_queue, tile_source, view_state
+
+# Replace the coarse map tile by tile. Each run queries one batch of tiles,
+# sends only their cells for mergeRefinedCells to swap in, and writes the
+# shortened queue back, which triggers the next run.
+@app.callback(
+    [Output('refined-cells', 'data'),
+     Output('refine-queue', 'data', allow_duplicate=True)],
+    Input('refine-queue', 'data'),
+    [State('refresh-button', 'n_clicks'),
+     State('session-id', 'data'),
+     State('time-column', 'value'),
+     State('compare-column', 'value')],
+    prevent_initial_call=True
+)
+def refine_map(queue, n_clicks, session_id, time_column, compare_column):
+    if not queue or not queue["pending"] or queue["generation"] != n_clicks or time_column or compare_column:
+        # Done, superseded by a newer refresh, or the layer now shows time frames or a comparison
+        raise PreventUpdate
+    query = queue["query"]
+    batch = [int(tile, 16) for tile in queue["pending"][:PROGRESSIVE_TILES_PER_STEP]]
+    print(f"Refining {len(batch)} tiles, {len(queue['pending']) - len(batch)} left")
+
+    with session_queries(session_id, queue["generation"]):
+        fine_data = get_data(**dict(query, tiles=batch))
+    if is_superseded(session_id, queue["generation"]):
+        raise PreventUpdate
+    if len(fine_data) > 0 and MAX_RENDER_CELLS > 0:
+        # Each batch gets its share of the cap, so the finished map stays under it
+        max_cells = max(1, MAX_RENDER_CELLS * len(batch) // queue["tile_count"])
+        fine_data = cap_render_cells(fine_data, max_cells, query["resolution"], min_resolution=tile_resolution_for(query["resolution"]))
+
+    refined = {"generation": queue["generation"], "tiles": [format(tile, "x") for tile in batch]}
+    if BOUNDARY_MODE == "client":
+        refined["cells"] = hex_cells_for_browser(build_hexagon_payload(fine_data, with_rings=False))
+    else:
+        data, _ = hexagon_layer_props(build_hexagon_payload(fine_data))
+        refined["features"] = data["features"]
+    return refined, dict(queue, pending=queue["pending"][len(batch):])
+
+# Swap each refined batch into the layer in the browser
+if PROGRESSIVE_REFRESH and MAP_RENDER_MODE == "geojson":
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="mergeRefinedCells"),
+        Output('hex-layer', 'data', allow_duplicate=True),
+        Input('refined-cells', 'data'),
+        State('hex-layer', 'data'),
+        prevent_initial_call=True,
+    )
+
+# Draw hexagon boundaries from cell IDs in the browser (BOUNDARY_MODE=client)
+if BOUNDARY_MODE == "client" and MAP_RENDER_MODE == "geojson":
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="cellsToGeoJSON"),
+        Output('hex-layer', 'data'),
+        Input('hex-cells', 'data'),
+    )
+
+# Fetch the hexagons for the visible XYZ tiles in parallel (MAP_RENDER_MODE=tiles)
+if MAP_RENDER_MODE == "tiles":
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="loadTiles"),
+        Output('hex-layer', 'data'),
+        [Input('map-container', 'bounds'),
+         Input('map-container', 'zoom'),
+         Input('tile-source', 'data')],
+    )
+
+# Recolor the hexagons and redraw the legend in the browser from the counts
+# already on the layer, whenever the data or the style controls change
+if MAP_RENDER_MODE != "polygons":
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="restyle"),
+        [Output('hex-layer', 'hideout', allow_duplicate=True),
+         Output('legend-container', 'children', allow_duplicate=True)],
+        [Input('hex-layer', 'data'),
+         Input('color-scheme', 'value'),
+         Input('bin-count', 'value'),
+         Input('fill-opacity', 'value'),
+         Input('time-frame', 'value'),
+         Input('compare-view', 'value'),
+         Input('compare-swipe', 'value'),
+         Input('map-container', 'bounds')],
+        [State('hex-layer', 'hideout'),
+         State('legend-style', 'data')],
+        prevent_initial_call='initial_duplicate',
+    )
+
+# Time animation (MAP_RENDER_MODE=geojson). One query fetches every frame of
+# the refreshed viewport; the browser then draws the cells once and steps
+# through the frames by changing only the layer's hideout.
+if MAP_RENDER_MODE == "geojson":
+    @app.callback(
+        [Output('time-column', 'options'),
+         Output('time-column', 'value')],
+        Input('column-info', 'data'),
+        [State('catalog-dropdown', 'value'),
+         State('schema-dropdown', 'value'),
+         State('table-dropdown', 'value'),
+         State('column-dropdown', 'value')],
+        prevent_initial_call=True
+    )
+    def populate_time_columns(column_info, catalog, schema, table, column):
+        """List the columns the time slider can animate when a valid H3 column is selected"""
+        if not column_info:
+            return [], None
+        try:
+            return get_time_columns(catalog, schema, table), None
+        except Exception as e:
+            print(f"Error fetching time columns for table {catalog}.{schema}.{table}: {e}")
+            return [], None
+
+    @app.callback(
+        [Output('time-frames', 'data'),
+         Output('time-frame', 'max'),
+         Output('time-frame', 'value')],
+        [Input('time-column', 'value'),
+         Input('view-state', 'data')],
+        [State('catalog-dropdown', 'value'),
+         State('schema-dropdown', 'value'),
+         State('table-dropdown', 'value'),
+         State('column-dropdown', 'value'),
+         State('column-info', 'data')],
+        prevent_initial_call=True
+    )
+    def load_time_frames(time_column, view_state, catalog, schema, table, column, column_info):
+        """Fetch the cell x frame counts for the last refreshed viewport"""
+        view_state = view_state or {}
+        if not time_column or not column_info or not view_state.get("bounds"):
+            return None, 0, 0
+        # Only options offered in the dropdown, whose SQL is built from the table's own column names
+        frame_options = get_time_frame_options(catalog, schema, table)
+        if time_column not in frame_options:
+            raise PreventUpdate
+        try:
+            cells, frames, matrix = get_time_frames(catalog, schema, table, column, frame_options[time_column][1], view_state["resolution"],
+                                                    view_state["bounds"], column_info["resolution"])
+        except Exception as e:
+            print(f"An error occurred in querying time frames: {str(e)}")
+            return None, 0, 0
+        if len(frames) == 0:
+            return None, 0, 0
+        return time_frames_for_browser(cells, frames, matrix), len(frames) - 1, 0
+
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="timeFramesToGeoJSON"),
+        Output('hex-layer', 'data', allow_duplicate=True),
+        Input('time-frames', 'data'),
+        State('hex-layer', 'data'),
+        prevent_initial_call=True,
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="timePlay"),
+        [Output('time-interval', 'disabled'),
+         Output('time-play', 'children')],
+        [Input('time-play', 'n_clicks'),
+         Input('time-frames', 'data')],
+        State('time-interval', 'disabled'),
+        prevent_initial_call=True,
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="timeStep"),
+        Output('time-frame', 'value', allow_duplicate=True),
+        Input('time-interval', 'n_intervals'),
+        [State('time-frame', 'value'),
+         State('time-frame', 'max')],
+        prevent_initial_call=True,
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="timeFrameLabel"),
+        Output('time-frame-label', 'children'),
+        [Input('time-frame', 'value'),
+         Input('time-frames', 'data')],
+    )
+
+# Compare mode (MAP_RENDER_MODE=geojson). One scan counts two H3 columns of the
+# table per cell; the difference, ratio and swipe views are all restyles of the
+# same hexagons in the browser.
+if MAP_RENDER_MODE == "geojson":
+    @app.callback(
+        [Output('compare-column', 'options'),
+         Output('compare-column', 'value')],
+        Input('column-info', 'data'),
+        [State('catalog-dropdown', 'value'),
+         State('schema-dropdown', 'value'),
+         State('table-dropdown', 'value'),
+         State('column-dropdown', 'value')],
+        prevent_initial_call=True
+    )
+    def populate_compare_columns(column_info, catalog, schema, table, column):
+        """List the table's H3 columns outside the selected column's family when a valid H3 column is selected"""
+        if not column_info:
+            return [], None
+        try:
+            family = get_h3_column_family(catalog, schema, table, column)
+            return [name for name in get_h3_columns(catalog, schema, table) if name not in family], None
+        except Exception as e:
+            print(f"Error fetching compare columns for table {catalog}.{schema}.{table}: {e}")
+            return [], None
+
+    # Time animation and comparison both take over the hexagon layer, so only one at a time
+    @app.callback(
+        [Output('time-column', 'disabled'),
+         Output('compare-column', 'disabled')],
+        [Input('compare-column', 'value'),
+         Input('time-column', 'value')],
+    )
+    def exclusive_layer_modes(compare_column, time_column):
+        return bool(compare_column), bool(time_column)
+
+    @app.callback(
+        Output('compare-cells', 'data'),
+        [Input('compare-column', 'value'),
+         Input('view-state', 'data')],
+        [State('catalog-dropdown', 'value'),
+         State('schema-dropdown', 'value'),
+         State('table-dropdown', 'value'),
+         State('column-dropdown', 'value'),
+         State('column-info', 'data')],
+        prevent_initial_call=True
+    )
+    def load_compare_cells(compare_column, view_state, catalog, schema, table, column, column_info):
+        """Fetch the counts of both columns for the last refreshed viewport"""
+        view_state = view_state or {}
+        if not compare_column or not column_info or not view_state.get("bounds"):
+            return None
+        # Only columns offered in the dropdown, which also keeps the name safe to put in SQL
+        if compare_column == column or compare_column not in get_h3_columns(catalog, schema, table):
+            raise PreventUpdate
+        try:
+            data = get_compare_data(catalog, schema, table, column, compare_column, view_state["resolution"],
+                                    view_state["bounds"], column_info["resolution"])
+        except Exception as e:
+            print(f"An error occurred in querying the comparison: {str(e)}")
+            return None
+        return compare_cells_for_browser(data, column, compare_column)
+
+    app.clientside_callback(
+        ClientsideFunction(namespace="h3viz", function_name="compareToGeoJSON"),
+        Output('hex-layer', 'data', allow_duplicate=True),
+        Input('compare-cells', 'data'),
+        State('hex-layer', 'data'),
+        prevent_initial_call=True,
+    )
+
+@app.server.route("/tiles/<table_name>/<column>/<int:column_resolution>/<int:z>/<int:x>/<int:y>")
+def xyz_tile(table_name, column, column_resolution, z, x, y):
+    """Binary H3 aggregates for one XYZ tile (see encode_cells_binary), with counts per km².
+
+    column_resolution is the column's H3 resolution as validated at refresh.
+    It is checked against the cached column info when there is one, and
+    never probed here. The ETag covers the table version and the caller's
+    cache scope, so a browser revalidating an unchanged tile gets a 304
+    without a data query.
+    """
+    names = table_name.split(".")
+    if len(names) != 3 or not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z and 0 < column_resolution <= 15):
+        flask.abort(404)
+    catalog, schema, table = names
+    # Only names the caller can see in the dropdowns, which also keeps them safe to put in SQL
+    if table not in get_tables(catalog, schema) or column not in get_columns(catalog, schema, table):
+        flask.abort(404)
+    scope = get_cache_scope(catalog, schema, table)
+    column_info = column_info_cache.get((table_name.lower(), column.lower(), scope))
+    if column_info is not None and column_info["resolution"] != column_resolution:
+        flask.abort(404)
+    resolution = min(zoom_to_h3_resolution(z), column_resolution)
+
+    version = get_table_version(catalog, schema, table)
+    etag = None
+    if version is not None:
+        etag_key = (table_name.lower(), column.lower(), z, x, y, resolution, version, scope)
+        etag = hashlib.sha256(repr(etag_key).encode()).hexdigest()[:32]
+        if etag in flask.request.if_none_match:
+            response = flask.Response(status=304)
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = f"private, max-age={TILE_MAX_AGE_SECONDS}"
+            return response
+
+    try:
+        cells, density = xyz_tile_cells(catalog, schema, table, column, resolution, column_resolution, z, x, y)
+    except Exception as e:
+        # Never let a failed query be cached or revalidated as an empty tile
+        print(f"An error occurred in querying tile {z}/{x}/{y}: {str(e)}")
+        response = flask.Response(status=503)
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    response = flask.Response(encode_cells_binary(cells, density), mimetype="application/octet-stream")
+    if etag is None:
+        # Without a table version there is nothing to validate against
+        response.headers["Cache-Control"] = "no-store"
+    else:
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = f"private, max-age={TILE_MAX_AGE_SECONDS}"
+    return response
+
+@app.server.route("/api/cache-stats")
+def cache_stats():
+    """Hit/miss counters for the server-side caches, and warehouse queue and coalescing counters."""
+    return flask.jsonify({"viewport_tiles": get_tile_cache_stats(), "warehouse_queries": get_query_stats(),
+                          "prefetch": get_prefetch_stats()})
+
+# Give each page load an ID so its superseded queries can be cancelled
+app.clientside_callback(
+    ClientsideFunction(namespace="h3viz", function_name="sessionId"),
+    Output('session-id', 'data'),
+    Input('url', 'pathname'),
+    State('session-id', 'data'),
+)
+
+# Click Refresh Map once the viewport has settled, when auto refresh is on
+app.clientside_callback(
+    ClientsideFunction(namespace="h3viz", function_name="autoRefresh"),
+    Output('auto-refresh-status', 'data'),
+    [Input('map-container', 'bounds'),
+     Input('map-container', 'zoom'),
+     Input('auto-refresh', 'value')],
+    State('auto-refresh-config', 'data'),
+)
 
 # Callback to populate catalog dropdown on app load
 @app.callback(
@@ -564,14 +2672,14 @@ def update_map_and_legend(n_clicks, center, zoom, bounds, catalog, schema, table
      Output('catalog-dropdown', 'value')],
     [Input('catalog-dropdown', 'id'),
      Input("url", "pathname")],
+    State('view-state', 'data'),
     prevent_initial_call=False
 )
-def populate_catalogs(trigger, pathname):
+def populate_catalogs(trigger, pathname, view_state):
     """Populate the catalog dropdown with available catalogs"""
     # print("Populating catalogs dropdown...")
 
-    global load_defaults
-    global default_catalog
+    load_defaults = (view_state or {}).get("load_defaults", True)
 
     
     try:
@@ -595,14 +2703,14 @@ def populate_catalogs(trigger, pathname):
      Output('schema-dropdown', 'disabled'),
      Output('schema-dropdown', 'value')],
     [Input('catalog-dropdown', 'value')],
+    State('view-state', 'data'),
     prevent_initial_call=True
 )
-def populate_schemas(selected_catalog):
+def populate_schemas(selected_catalog, view_state):
     """Populate the schema dropdown when a catalog is selected"""
     # print(f"Populating schemas for catalog: {selected_catalog}")
 
-    global load_defaults
-    global default_schema
+    load_defaults = (view_state or {}).get("load_defaults", True)
 
     if not selected_catalog and default_schema is None:
         return [], "Select a schema...", True, None
@@ -625,15 +2733,15 @@ def populate_schemas(selected_catalog):
      Output('table-dropdown', 'disabled'),
      Output('table-dropdown', 'value')],
     Input('schema-dropdown', 'value'),
-    State('catalog-dropdown', 'value'),
+    [State('catalog-dropdown', 'value'),
+     State('view-state', 'data')],
     prevent_initial_call=False
 )
-def populate_tables(selected_schema, selected_catalog):
+def populate_tables(selected_schema, selected_catalog, view_state):
     """Populate the table dropdown when a schema is selected"""
     # print(f"Populating tables for schema: {selected_schema}, catalog: {selected_catalog}")
     
-    global load_defaults
-    global default_table
+    load_defaults = (view_state or {}).get("load_defaults", True)
 
     if (not selected_schema or not selected_catalog) and default_table is None:
         return [], "Select a table...", True, None
@@ -656,15 +2764,15 @@ def populate_tables(selected_schema, selected_catalog):
      Output('column-dropdown', 'value')],
     Input('table-dropdown', 'value'),
     [State('catalog-dropdown', 'value'),
-     State('schema-dropdown', 'value')],
+     State('schema-dropdown', 'value'),
+     State('view-state', 'data')],
     prevent_initial_call=False
 )
-def populate_columns(selected_table, selected_catalog, selected_schema):
+def populate_columns(selected_table, selected_catalog, selected_schema, view_state):
     """Populate the column dropdown when a table is selected"""
     # print(f"Populating columns for table: {selected_table}, schema: {selected_schema}, catalog: {selected_catalog}")
 
-    global load_defaults
-    global default_column
+    load_defaults = (view_state or {}).get("load_defaults", True)
 
     if (not selected_table or not selected_catalog or not selected_schema) and default_column is None:
         return [], "Select a column...", True, None
@@ -682,6 +2790,7 @@ def populate_columns(selected_table, selected_catalog, selected_schema):
 # Callback to validate column and show description
 @app.callback(
     [Output('column-description', 'children'),
+     Output('column-info', 'data'),
      Output('refresh-button', 'disabled'),
      Output('refresh-button', 'style'),
      Output('refresh-button', 'title')],
@@ -722,28 +2831,24 @@ def validate_column(selected_column, selected_catalog, selected_schema, selected
     }
     
     if not selected_column or not selected_catalog or not selected_schema or not selected_table:
-        return "", True, disabled_style, "Select a valid H3 column"
+        return "", None, True, disabled_style, "Select a valid H3 column"
     
     print(f"Validating column: {selected_column}, table: {selected_table}, schema: {selected_schema}, catalog: {selected_catalog}")
 
     try:
-        resolution_query = f"SELECT h3_resolution({selected_column}) as resolution FROM {selected_catalog}.{selected_schema}.{selected_table} LIMIT 1"
-        column_resolution = sqlQuery(resolution_query)['resolution'].iloc[0]
-        # print(f"Column resolution: {column_resolution}")
-
-        count_query = f"SELECT COUNT(*) as count FROM {selected_catalog}.{selected_schema}.{selected_table} WHERE {selected_column} IS NOT NULL"
-        count_result = sqlQuery(count_query)['count'].iloc[0]
-        # print(f"Count result: {count_result}")
+        column_info = get_column_info(selected_catalog, selected_schema, selected_table, selected_column)
+        column_resolution = column_info["resolution"]
+        count_result = column_info["row_count"]
 
         if column_resolution is None or column_resolution == 0 or count_result == 0:
             print("Column resolution is None or count is 0.")
-            return "Column is not valid H3", True, disabled_style, "Must select a valid H3 column"
+            return "Column is not valid H3", None, True, disabled_style, "Must select a valid H3 column"
         else:
             print("Column resolution is valid. Returning columns.")
-            return f"Column resolution: {column_resolution}; Row count: {format(count_result, ',')}", False, enabled_style, "Refresh map"
+            return f"Column resolution: {column_resolution}; Table rows: {format(count_result, ',')}", column_info, False, enabled_style, "Refresh map"
     except Exception as e:
         print(f"Column is not valid H3: {e}")
-        return "Column is not valid H3", True, disabled_style, "Must select a valid H3 column"
+        return "Column is not valid H3", None, True, disabled_style, "Must select a valid H3 column"
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
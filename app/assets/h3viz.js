@@ -0,0 +1,434 @@
+window.h3viz = Object.assign({}, window.h3viz, {
+    map: {
+        // Style a hexagon feature from its numeric property. hideout carries the
+        // legend breaks (classes), the matching colors and the base polygon style,
+        // the frame to color by when the layer holds time frames, and the swipe
+        // longitude west of which a comparison shows the first column.
+        styleHexagon: function(feature, context) {
+            const {classes, colorscale, style, colorProp, defaultColor, frame, swipe} = context.hideout;
+            const frames = window.h3viz.timeFrames;
+            let value = feature.properties[colorProp];
+            if (frame != null && frames && feature.properties.row != null) {
+                value = frames.counts[feature.properties.row * frames.n + frame];
+            } else if (swipe != null && feature.properties.lng != null) {
+                value = feature.properties.lng < swipe ? feature.properties.count_a : feature.properties.count_b;
+            }
+            let color = defaultColor;
+            for (let i = 0; i < classes.length; ++i) {
+                if (value >= classes[i]) {
+                    color = colorscale[i];
+                }
+            }
+            return Object.assign({}, style, {fillColor: color, color: color});
+        }
+    },
+
+    // GeoJSON features from a binary tile: uint32 cell count, (high, low) uint32
+    // halves of each cell ID, then one float32 count per cell, all little-endian.
+    decodeTile: function(buffer) {
+        const n = new DataView(buffer).getUint32(0, true);
+        // Typed arrays use the platform byte order, which is little-endian in every browser
+        return window.h3viz.hexagonFeatures(new Uint32Array(buffer, 4, 2 * n), new Float32Array(buffer, 4 + 8 * n, n));
+    },
+
+    // Features from interleaved (high, low) uint32 halves of the cell IDs and their counts
+    hexagonFeatures: function(halves, counts) {
+        const features = new Array(counts.length);
+        for (let i = 0; i < counts.length; ++i) {
+            const cell = halves[2 * i].toString(16) + halves[2 * i + 1].toString(16).padStart(8, "0");
+            features[i] = {
+                type: "Feature",
+                geometry: {type: "Polygon", coordinates: [h3.cellToBoundary(cell, true)]},
+                properties: {count: counts[i]}
+            };
+        }
+        return features;
+    },
+
+    // k colors evenly interpolated along the palette stops
+    interpolatePalette: function(palette, k) {
+        const rgb = palette.map(color => [1, 3, 5].map(i => parseInt(color.slice(i, i + 2), 16)));
+        const colors = [];
+        for (let i = 0; i < k; ++i) {
+            const t = k === 1 ? 0 : i / (k - 1) * (rgb.length - 1);
+            const lower = Math.min(Math.floor(t), rgb.length - 2);
+            const mix = rgb[lower].map((c, j) => Math.round(c + (rgb[lower + 1][j] - c) * (t - lower)));
+            colors.push("#" + mix.map(c => c.toString(16).padStart(2, "0")).join("").toUpperCase());
+        }
+        return colors;
+    },
+
+    // k + 1 class breaks from the minimum to the maximum of values
+    colorBreaks: function(values, scheme, k) {
+        const sorted = Float64Array.from(values.filter(Number.isFinite)).sort();
+        const n = sorted.length;
+        if (n === 0) {
+            return Array.from({length: k + 1}, (_, i) => i + 1);
+        }
+        const min = sorted[0];
+        const max = sorted[n - 1];
+        const positive = sorted.filter(v => v > 0);
+        if (scheme === "log" && positive.length > 0) {
+            const logMin = Math.log10(positive[0]);
+            const logMax = Math.log10(max);
+            return Array.from({length: k + 1}, (_, i) => 10 ** (logMin + (logMax - logMin) * i / k));
+        }
+        if (scheme === "quantile") {
+            return Array.from({length: k + 1}, (_, i) => sorted[Math.floor(i * (n - 1) / k)]);
+        }
+        if (scheme === "jenks") {
+            // Fisher-Jenks is quadratic, so it runs on an evenly spaced sample of at most 1000 values
+            const m = Math.min(n, 1000);
+            const sample = Array.from({length: m}, (_, i) => sorted[Math.floor(i * (n - 1) / Math.max(m - 1, 1))]);
+            return window.h3viz.jenksBreaks(sample, k);
+        }
+        return Array.from({length: k + 1}, (_, i) => min + (max - min) * i / k);
+    },
+
+    // Natural breaks of sorted data into k classes: [min, lower bound of classes 2..k, max]
+    jenksBreaks: function(data, k) {
+        const n = data.length;
+        if (n <= k) {
+            return Array.from({length: k + 1}, (_, i) => data[Math.min(i, n - 1)]);
+        }
+        const lowerClassLimits = Array.from({length: n + 1}, () => new Array(k + 1).fill(0));
+        const varianceCombinations = Array.from({length: n + 1}, () => new Array(k + 1).fill(0));
+        for (let j = 1; j <= k; ++j) {
+            lowerClassLimits[1][j] = 1;
+            for (let i = 2; i <= n; ++i) {
+                varianceCombinations[i][j] = Infinity;
+            }
+        }
+        for (let l = 2; l <= n; ++l) {
+            let sum = 0, sumSquares = 0, variance = 0;
+            for (let m = 1; m <= l; ++m) {
+                const lowerClassLimit = l - m + 1;
+                const value = data[lowerClassLimit - 1];
+                sum += value;
+                sumSquares += value * value;
+                variance = sumSquares - sum * sum / m;
+                if (lowerClassLimit > 1) {
+                    for (let j = 2; j <= k; ++j) {
+                        const candidate = variance + varianceCombinations[lowerClassLimit - 1][j - 1];
+                        if (varianceCombinations[l][j] >= candidate) {
+                            lowerClassLimits[l][j] = lowerClassLimit;
+                            varianceCombinations[l][j] = candidate;
+                        }
+                    }
+                }
+            }
+            lowerClassLimits[l][1] = 1;
+            varianceCombinations[l][1] = variance;
+        }
+        const breaks = new Array(k + 1);
+        breaks[0] = data[0];
+        breaks[k] = data[n - 1];
+        let end = n;
+        for (let j = k; j >= 2; --j) {
+            const start = lowerClassLimits[end][j];
+            breaks[j - 1] = data[start - 1];
+            end = start - 1;
+        }
+        return breaks;
+    },
+
+    formatBreak: function(value) {
+        return value >= 10 ? String(Math.trunc(value)) : String(Number(value.toPrecision(2)));
+    },
+
+    // The same component tree as create_legend, for the restyle callback
+    legend: function(breaks, colors, title, styles) {
+        const format = window.h3viz.formatBreak;
+        const k = colors.length;
+        const labels = colors.map((_, i) => {
+            if (i === 0) {
+                return `< ${format(breaks[1])}`;
+            }
+            return i === k - 1 ? `≥ ${format(breaks[i])}` : `${format(breaks[i])}-${format(breaks[i + 1])}`;
+        });
+        const div = (children, style) => ({namespace: "dash_html_components", type: "Div", props: {children: children, style: style}});
+        const items = colors.map((color, i) => div([
+            div(null, Object.assign({}, styles.swatch, {backgroundColor: color})),
+            {namespace: "dash_html_components", type: "Span", props: {children: labels[i], style: styles.label}}
+        ], styles.item));
+        return div([div(title, styles.title), div(items)], styles.legend);
+    },
+
+    // Typed array view over a base64 buffer from hex_cells_for_browser
+    decodeBase64: function(text, ArrayType) {
+        const bytes = Uint8Array.from(atob(text), c => c.charCodeAt(0));
+        return new ArrayType(bytes.buffer);
+    }
+});
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    h3viz: {
+        // Build the hexagon FeatureCollection from hex-string cell IDs with h3-js.
+        // Coarse cells of a progressive refresh keep their tile and generation
+        // for mergeRefinedCells.
+        cellsToGeoJSON: function(hexCells) {
+            if (!hexCells) {
+                return window.dash_clientside.no_update;
+            }
+            let features;
+            if (hexCells.encoding === "base64") {
+                const decode = window.h3viz.decodeBase64;
+                features = window.h3viz.hexagonFeatures(decode(hexCells.cells, Uint32Array), decode(hexCells.counts, Float32Array));
+            } else {
+                features = hexCells.cells.map((cell, i) => ({
+                    type: "Feature",
+                    geometry: {type: "Polygon", coordinates: [h3.cellToBoundary(cell, true)]},
+                    properties: {count: hexCells.counts[i]}
+                }));
+            }
+            if (hexCells.tiles) {
+                features.forEach((feature, i) => {
+                    feature.properties.tile = hexCells.tiles[i];
+                });
+                return {type: "FeatureCollection", features: features, generation: hexCells.generation};
+            }
+            return {type: "FeatureCollection", features: features};
+        },
+
+        // Replace the coarse cells of a batch of refined tiles with the batch's
+        // full-resolution cells. Batches from an earlier refresh, or arriving
+        // after the layer switched to time frames or a comparison, are dropped.
+        mergeRefinedCells: function(refined, data) {
+            if (!refined || !data || data.generation !== refined.generation) {
+                return window.dash_clientside.no_update;
+            }
+            const tiles = new Set(refined.tiles);
+            const added = refined.features || window.dash_clientside.h3viz.cellsToGeoJSON(refined.cells).features;
+            const features = data.features.filter(feature => !tiles.has(feature.properties.tile)).concat(added);
+            return Object.assign({}, data, {features: features});
+        },
+
+        // Hexagons for the XYZ tiles covering the viewport (MAP_RENDER_MODE=tiles).
+        // Tiles are fetched in parallel and kept per refresh, so panning back to
+        // an area already seen draws it without any request.
+        loadTiles: function(bounds, zoom, source) {
+            const state = window.h3viz;
+            if (!source || !bounds) {
+                return window.dash_clientside.no_update;
+            }
+            if (!state.tiles || state.tiles.generation !== source.generation) {
+                state.tiles = {generation: source.generation, features: new Map()};
+            }
+            const tiles = state.tiles;
+            const z = Math.max(0, Math.round(zoom));
+            const n = 2 ** z;
+            const tileX = lng => Math.floor((lng + 180) / 360 * n);
+            const tileY = lat => {
+                const phi = lat * Math.PI / 180;
+                const y = Math.floor((1 - Math.log(Math.tan(phi) + 1 / Math.cos(phi)) / Math.PI) / 2 * n);
+                return Math.min(Math.max(y, 0), n - 1);
+            };
+            const [[south, west], [north, east]] = bounds;
+            const urls = [];
+            for (let x = tileX(west); x <= Math.min(tileX(east), tileX(west) + n - 1); ++x) {
+                for (let y = tileY(north); y <= tileY(south); ++y) {
+                    urls.push(`${source.url}/${z}/${((x % n) + n) % n}/${y}`);
+                }
+            }
+            const request = (tiles.request || 0) + 1;
+            tiles.request = request;
+            return Promise.all(urls.map(url => {
+                if (tiles.features.has(url)) {
+                    return tiles.features.get(url);
+                }
+                const pending = fetch(url, {credentials: "same-origin"})
+                    .then(response => {
+                        if (!response.ok) {
+                            throw new Error(`${url}: ${response.status}`);
+                        }
+                        return response.arrayBuffer();
+                    })
+                    .then(buffer => window.h3viz.decodeTile(buffer))
+                    .catch(() => {
+                        // Draw nothing for now, and request the tile again on the next pan or zoom
+                        tiles.features.delete(url);
+                        return [];
+                    });
+                tiles.features.set(url, pending);
+                return pending;
+            })).then(lists => {
+                if (tiles.request !== request || state.tiles !== tiles) {
+                    // A newer viewport is already loading
+                    return window.dash_clientside.no_update;
+                }
+                return {type: "FeatureCollection", features: [].concat(...lists)};
+            });
+        },
+
+        // Hexagons for the time animation, drawn once per load of time frames. The
+        // cell x frame matrix stays in window.h3viz.timeFrames for styleHexagon;
+        // each cell's count is its busiest frame, so every frame shares one color
+        // scale. Without frames, a time-framed layer goes back to the totals.
+        timeFramesToGeoJSON: function(frames, data) {
+            const state = window.h3viz;
+            if (!frames) {
+                if (!data || !data.timeFrames || !state.timeFrames) {
+                    return window.dash_clientside.no_update;
+                }
+                const {counts, n} = state.timeFrames;
+                const features = data.features.map(feature => {
+                    let total = 0;
+                    for (let j = 0; j < n; ++j) {
+                        total += counts[feature.properties.row * n + j];
+                    }
+                    return Object.assign({}, feature, {properties: {count: total}});
+                });
+                state.timeFrames = null;
+                return {type: "FeatureCollection", features: features};
+            }
+            const counts = state.decodeBase64(frames.counts, Float32Array);
+            const n = frames.frames.length;
+            const peaks = new Float32Array(counts.length / n);
+            for (let i = 0; i < peaks.length; ++i) {
+                for (let j = 0; j < n; ++j) {
+                    peaks[i] = Math.max(peaks[i], counts[i * n + j]);
+                }
+            }
+            const features = state.hexagonFeatures(state.decodeBase64(frames.cells, Uint32Array), peaks);
+            features.forEach((feature, i) => {
+                feature.properties.row = i;
+            });
+            state.timeFrames = {counts: counts, n: n};
+            return {type: "FeatureCollection", features: features, timeFrames: true};
+        },
+
+        // Hexagons for comparing two columns, with both counts, their difference,
+        // the log2 ratio and the center longitude for the swipe view. Without a
+        // comparison, a compared layer goes back to the first column's counts.
+        compareToGeoJSON: function(compare, data) {
+            const state = window.h3viz;
+            if (!compare) {
+                if (!data || !data.compare) {
+                    return window.dash_clientside.no_update;
+                }
+                const features = data.features
+                    .filter(feature => feature.properties.count_a > 0)
+                    .map(feature => Object.assign({}, feature, {properties: {count: feature.properties.count_a}}));
+                return {type: "FeatureCollection", features: features};
+            }
+            const countsA = state.decodeBase64(compare.counts_a, Float32Array);
+            const countsB = state.decodeBase64(compare.counts_b, Float32Array);
+            const features = state.hexagonFeatures(state.decodeBase64(compare.cells, Uint32Array), countsA);
+            features.forEach((feature, i) => {
+                // GeoJSON rings repeat the first vertex at the end
+                const ring = feature.geometry.coordinates[0].slice(0, -1);
+                Object.assign(feature.properties, {
+                    count_a: countsA[i],
+                    count_b: countsB[i],
+                    diff: countsA[i] - countsB[i],
+                    ratio: Math.log2((countsA[i] + 1) / (countsB[i] + 1)),
+                    lng: ring.reduce((sum, point) => sum + point[0], 0) / ring.length
+                });
+            });
+            return {type: "FeatureCollection", features: features, compare: {columns: compare.columns}};
+        },
+
+        // Start or stop playing; new frames keep the current state, no frames stop it
+        timePlay: function(nClicks, frames, disabled) {
+            const no_update = window.dash_clientside.no_update;
+            if (!frames) {
+                return [true, "Play"];
+            }
+            const triggered = window.dash_clientside.callback_context.triggered.map(t => t.prop_id);
+            if (!triggered.includes("time-play.n_clicks")) {
+                return [no_update, no_update];
+            }
+            return disabled ? [false, "Pause"] : [true, "Play"];
+        },
+
+        timeStep: function(nIntervals, frame, max) {
+            return max > 0 ? (frame + 1) % (max + 1) : window.dash_clientside.no_update;
+        },
+
+        timeFrameLabel: function(frame, frames) {
+            return frames ? `${frames.frames[frame]} (${frame + 1}/${frames.frames.length})` : "";
+        },
+
+        // Recolor the hexagon layer and rebuild the legend from the counts on the
+        // layer, so changing the scheme, bin count or opacity needs no server call.
+        // On a time-framed layer the frame is passed on for styleHexagon. On a
+        // compared layer the view picks the property: differences and ratios use
+        // diverging colors symmetric around zero, the swipe view shows the first
+        // column west of the slider's position in the viewport and the second east.
+        restyle: function(data, scheme, binCount, opacity, frame, compareView, swipe, bounds, hideout, legendStyle) {
+            const no_update = window.dash_clientside.no_update;
+            if (!data || !hideout || !hideout.palette) {
+                return [no_update, no_update];
+            }
+            const triggered = window.dash_clientside.callback_context.triggered.map(t => t.prop_id);
+            if (triggered.length === 1 && triggered[0] === "map-container.bounds" && !(data.compare && compareView === "swipe")) {
+                // Panning only moves the swipe line
+                return [no_update, no_update];
+            }
+            let colorProp = "count";
+            let title = hideout.legendTitle;
+            let palette = hideout.palette;
+            let swipeLng = null;
+            let values;
+            let breaks;
+            if (data.compare && compareView !== "swipe") {
+                const [a, b] = data.compare.columns;
+                colorProp = compareView;
+                title = compareView === "ratio" ? `log₂ ${a} / ${b}` : `${a} − ${b}`;
+                palette = hideout.divergingPalette;
+                values = data.features.map(feature => feature.properties[colorProp]);
+                const extent = values.reduce((max, v) => Math.max(max, Math.abs(v)), 1e-9);
+                breaks = Array.from({length: binCount + 1}, (_, i) => -extent + 2 * extent * i / binCount);
+            } else {
+                values = data.features.map(feature => feature.properties[colorProp]);
+                if (data.compare) {
+                    const [a, b] = data.compare.columns;
+                    title = `${a} ◀ | ▶ ${b}`;
+                    values = values.concat(data.features.map(feature => feature.properties.count_b));
+                    if (bounds) {
+                        swipeLng = bounds[0][1] + (bounds[1][1] - bounds[0][1]) * swipe;
+                    }
+                }
+                breaks = window.h3viz.colorBreaks(values, scheme, binCount);
+            }
+            const colors = window.h3viz.interpolatePalette(palette, binCount);
+            const restyled = Object.assign({}, hideout, {
+                classes: breaks.slice(0, binCount),
+                colorscale: colors,
+                colorProp: colorProp,
+                style: Object.assign({}, hideout.style, {fillOpacity: opacity}),
+                frame: data.timeFrames ? frame : null,
+                swipe: swipeLng
+            });
+            return [restyled, window.h3viz.legend(breaks, colors, title, legendStyle)];
+        },
+
+        sessionId: function(pathname, sessionId) {
+            return sessionId || window.crypto.randomUUID();
+        },
+
+        // Debounced auto refresh. Only the last viewport of a burst of pans clicks
+        // Refresh Map, and a viewport that was already requested (such as the
+        // re-rendered map after a refresh) is ignored.
+        autoRefresh: function(bounds, zoom, enabled, config) {
+            const state = window.h3viz;
+            if (!bounds) {
+                return window.dash_clientside.no_update;
+            }
+            const viewport = JSON.stringify([bounds.map(p => p.map(v => v.toFixed(4))), zoom]);
+            clearTimeout(state.autoRefreshTimer);
+            if (!enabled || !enabled.length || viewport === state.lastViewport) {
+                state.lastViewport = viewport;
+                return window.dash_clientside.no_update;
+            }
+            state.autoRefreshTimer = setTimeout(function() {
+                state.lastViewport = viewport;
+                const button = document.getElementById("refresh-button");
+                if (button && !button.disabled) {
+                    button.click();
+                }
+            }, config.debounce_ms);
+            return viewport;
+        }
+    }
+});
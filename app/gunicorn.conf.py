@@ -0,0 +1,14 @@
+# Production server settings, used by app.yml: gunicorn -c gunicorn.conf.py app:server
+import os
+
+bind = f"0.0.0.0:{os.getenv('DATABRICKS_APP_PORT', '8000')}"
+# Threaded workers, since most of a callback's time is spent waiting on the warehouse
+worker_class = "gthread"
+# One process by default: query cancellation, coalescing, admission control,
+# the tile, metadata and density caches and prefetch live in process memory.
+# See "Multiple Workers" in the README for what changes with more
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Long enough for a cold query on a large table
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+accesslog = "-"
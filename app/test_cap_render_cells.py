@@ -0,0 +1,97 @@
+"""Checks that cap_render_cells conserves every count and never draws a cell twice.
+
+Run from the repository root with: python -m pytest app
+"""
+import h3
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from app import cap_render_cells, merge_progressive_data
+
+RESOLUTION = 9
+MIDTOWN = h3.latlng_to_cell(40.758, -73.9855, RESOLUTION)
+
+
+def cell_table(cells, counts):
+    order = np.argsort(-np.asarray(counts), kind="stable")
+    return pa.table({
+        "h3_cell_id": pa.array(np.array([h3.str_to_int(cell) for cell in cells], dtype=np.int64)[order]),
+        "count": pa.array(np.asarray(counts)[order]),
+    })
+
+
+@pytest.fixture
+def viewport():
+    """A sparse disk of res 9 cells with a dense core, counted per res 9 cell."""
+    rng = np.random.default_rng(7)
+    cells = sorted(h3.grid_disk(MIDTOWN, 30))
+    counts = rng.integers(1, 20, len(cells)).astype(np.int64)
+    core = set(h3.grid_disk(MIDTOWN, 4))
+    counts[[i for i, cell in enumerate(cells) if cell in core]] += 10000
+    return cell_table(cells, counts)
+
+
+def totals(data, resolution=RESOLUTION):
+    """Per-cell totals, undoing the per-resolution-cell units of coarser cells."""
+    cells = data.column('h3_cell_id').to_numpy()
+    resolutions = np.array([h3.get_resolution(h3.int_to_str(int(cell))) for cell in cells])
+    return data.column('count').to_numpy().astype(np.float64) * 7.0 ** (resolution - resolutions)
+
+
+def covering(cell, output):
+    """Output cells that are cell itself or one of its ancestors; output is a set."""
+    return [h3.cell_to_parent(cell, r) for r in range(h3.get_resolution(cell) + 1) if h3.cell_to_parent(cell, r) in output]
+
+
+@pytest.mark.parametrize("max_cells", [2000, 500, 100, 20])
+def test_cap_conserves_counts_and_covers_each_cell_once(viewport, max_cells):
+    capped = cap_render_cells(viewport, max_cells, RESOLUTION)
+    assert len(capped) <= max_cells
+    assert totals(capped).sum() == pytest.approx(totals(viewport).sum())
+    output = [h3.int_to_str(int(cell)) for cell in capped.column('h3_cell_id').to_numpy()]
+    output_set = set(output)
+    assert len(output_set) == len(output)
+    for cell in viewport.column('h3_cell_id').to_pylist():
+        assert len(covering(h3.int_to_str(cell), output_set)) == 1
+    # Each output cell holds exactly the input cells under it
+    expected = {}
+    for cell, total in zip(viewport.column('h3_cell_id').to_pylist(), totals(viewport)):
+        parent = covering(h3.int_to_str(cell), output_set)[0]
+        expected[parent] = expected.get(parent, 0) + total
+    assert [expected[cell] for cell in output] == pytest.approx(totals(capped).tolist())
+
+
+def test_cap_keeps_the_densest_cells_at_full_resolution(viewport):
+    capped = cap_render_cells(viewport, 1000, RESOLUTION)
+    output = {h3.int_to_str(int(cell)) for cell in capped.column('h3_cell_id').to_numpy()}
+    assert set(h3.grid_disk(MIDTOWN, 4)) <= output
+
+
+def test_cap_leaves_data_under_the_limit_alone(viewport):
+    assert cap_render_cells(viewport, len(viewport), RESOLUTION) is viewport
+    assert cap_render_cells(viewport, 0, RESOLUTION) is viewport
+
+
+def test_cap_of_progressive_data_conserves_counts(viewport):
+    # Coarse cells from merge_progressive_data are already per fine cell
+    coarse_cells = sorted(h3.grid_disk(h3.cell_to_parent(MIDTOWN, 7), 6))
+    coarse = cell_table(coarse_cells, np.full(len(coarse_cells), 49, dtype=np.int64))
+    tile_resolution = 6
+    refined = sorted({h3.str_to_int(h3.cell_to_parent(cell, tile_resolution)) for cell in h3.grid_disk(MIDTOWN, 4)})
+    fine = viewport.filter(pa.array(np.isin(
+        [h3.str_to_int(h3.cell_to_parent(h3.int_to_str(cell), tile_resolution)) for cell in viewport.column('h3_cell_id').to_pylist()],
+        refined)))
+    merged = merge_progressive_data(coarse, fine, refined, tile_resolution, 2)
+    capped = cap_render_cells(merged, 50, RESOLUTION)
+    assert len(capped) <= 50
+    assert totals(capped).sum() == pytest.approx(totals(merged).sum())
+
+
+def test_cap_stops_at_the_minimum_resolution(viewport):
+    capped = cap_render_cells(viewport, 20, RESOLUTION, min_resolution=7)
+    resolutions = [h3.get_resolution(h3.int_to_str(int(cell))) for cell in capped.column('h3_cell_id').to_numpy()]
+    # Too few res 7 parents to reach the cap, so it is exceeded rather than crossing them
+    assert min(resolutions) == 7
+    assert len(capped) > 20
+    assert totals(capped).sum() == pytest.approx(totals(viewport).sum())
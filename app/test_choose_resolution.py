@@ -0,0 +1,44 @@
+"""Checks that density observations only lower cell estimates where they were made.
+
+Run from the repository root with: python -m pytest app
+"""
+import h3
+import numpy as np
+import pytest
+
+import app
+from app import choose_h3_resolution, estimate_viewport_cells, record_tile_density, tile_resolution_for, viewport_tiles
+
+US = [[24.0, -125.0], [50.0, -66.0]]
+# A 1920x1080 window over Manhattan at zoom 11
+MIDTOWN = [[40.50, -74.64], [41.00, -73.32]]
+TABLE = ("c", "s", "t", "pickup_cell_12")
+
+
+@pytest.fixture(autouse=True)
+def empty_density_stats(monkeypatch):
+    monkeypatch.setattr(app, "density_stats", type(app.density_stats)())
+    monkeypatch.setattr(app, "density_levels", {})
+
+
+def record(resolution, bounds, cells):
+    tile_resolution = tile_resolution_for(resolution)
+    record_tile_density(*TABLE, resolution, viewport_tiles(bounds, tile_resolution), tile_resolution,
+                        np.array([h3.str_to_int(cell) for cell in cells], dtype=np.int64))
+
+
+def test_sparse_view_elsewhere_does_not_raise_the_resolution():
+    unobserved = choose_h3_resolution(MIDTOWN, 11, 12, *TABLE)
+    rng = np.random.default_rng(0)
+    scattered = {h3.latlng_to_cell(rng.uniform(25, 49), rng.uniform(-124, -67), 5) for _ in range(300)}
+    # Around New York the data is dense even at res 5
+    record(5, US, scattered | set(h3.grid_disk(h3.latlng_to_cell(40.75, -73.98, 5), 6)))
+    resolution = choose_h3_resolution(MIDTOWN, 11, 12, *TABLE)
+    assert resolution == unobserved
+    assert estimate_viewport_cells(MIDTOWN, resolution) <= app.RENDER_CELL_BUDGET
+
+
+def test_sparse_view_of_the_same_area_allows_finer_cells():
+    unobserved = choose_h3_resolution(MIDTOWN, 11, 12, *TABLE)
+    record(8, MIDTOWN, [h3.latlng_to_cell(40.75, -73.98, 8)])
+    assert choose_h3_resolution(MIDTOWN, 11, 12, *TABLE) > unobserved
@@ -0,0 +1,63 @@
+"""Checks of the H3 ID range planner against brute force with h3.cell_to_children.
+
+Run from the repository root with: python -m pytest app
+"""
+import h3
+import pytest
+
+from app import h3_child_range, h3_id_ranges
+
+MIDTOWN = h3.latlng_to_cell(40.758, -73.9855, 5)
+# Pentagons have no children with 1 as their first digit below the pentagon's resolution
+PENTAGON = h3.get_pentagons(3)[0]
+
+
+def children(cell, resolution):
+    return sorted(h3.str_to_int(child) for child in h3.cell_to_children(cell, resolution))
+
+
+def in_ranges(value, ranges):
+    return sum(low <= value <= high for low, high in ranges)
+
+
+@pytest.mark.parametrize("cell", [MIDTOWN, h3.cell_to_parent(MIDTOWN, 2), PENTAGON])
+@pytest.mark.parametrize("levels", [0, 1, 2, 4])
+def test_child_range_is_min_and_max_child(cell, levels):
+    child_resolution = h3.get_resolution(cell) + levels
+    expected = children(cell, child_resolution)
+    assert h3_child_range(h3.str_to_int(cell), child_resolution) == (expected[0], expected[-1])
+
+
+def test_child_range_excludes_siblings():
+    parent = h3.cell_to_parent(MIDTOWN, 4)
+    low, high = h3_child_range(h3.str_to_int(MIDTOWN), 8)
+    for sibling in h3.cell_to_children(parent, 5):
+        if sibling != MIDTOWN:
+            assert not any(low <= child <= high for child in children(sibling, 8))
+
+
+@pytest.mark.parametrize("k", [1, 3, 6])
+def test_id_ranges_cover_each_child_once_and_nothing_else(k):
+    cells = h3.grid_disk(MIDTOWN, k)
+    ranges = h3_id_ranges([h3.str_to_int(cell) for cell in cells], 8)
+    assert ranges == sorted(ranges)
+    assert all(low <= high < next_low for (low, high), (next_low, _) in zip(ranges, ranges[1:]))
+    for cell in cells:
+        assert all(in_ranges(child, ranges) == 1 for child in children(cell, 8))
+    for outside in h3.grid_ring(MIDTOWN, k + 1):
+        assert all(in_ranges(child, ranges) == 0 for child in children(outside, 8))
+
+
+def test_id_ranges_merge_a_full_set_of_siblings():
+    parent = h3.cell_to_parent(MIDTOWN, 4)
+    ranges = h3_id_ranges([h3.str_to_int(cell) for cell in h3.cell_to_children(parent, 5)], 7)
+    assert ranges == [h3_child_range(h3.str_to_int(parent), 7)]
+
+
+def test_id_ranges_around_a_pentagon():
+    cells = h3.grid_disk(PENTAGON, 2)
+    ranges = h3_id_ranges([h3.str_to_int(cell) for cell in cells], 5)
+    for cell in cells:
+        assert all(in_ranges(child, ranges) == 1 for child in children(cell, 5))
+    for outside in h3.grid_ring(PENTAGON, 3):
+        assert all(in_ranges(child, ranges) == 0 for child in children(outside, 5))
@@ -0,0 +1,43 @@
+"""Checks that viewport_tiles covers wide and antimeridian-crossing viewports.
+
+Run from the repository root with: python -m pytest app
+"""
+import h3
+
+from app import viewport_tiles, xyz_tile_bounds
+
+
+def all_cells(resolution):
+    return {h3.str_to_int(cell) for base in h3.get_res0_cells() for cell in h3.cell_to_children(base, resolution)}
+
+
+def test_world_tile_covers_every_cell_within_web_mercator():
+    # Only cells beyond the ±85.05° Web Mercator latitude limit are left out
+    tiles = set(viewport_tiles(xyz_tile_bounds(0, 0, 0), 2))
+    missing = all_cells(2) - tiles
+    assert all(abs(h3.cell_to_latlng(h3.int_to_str(cell))[0]) > 80 for cell in missing)
+    assert len(missing) < 20
+
+
+def test_zoom_1_tiles_cover_the_world_between_them():
+    tiles = set()
+    for x in range(2):
+        for y in range(2):
+            tiles.update(viewport_tiles(xyz_tile_bounds(1, x, y), 2))
+    assert tiles == set(viewport_tiles(xyz_tile_bounds(0, 0, 0), 2))
+
+
+def test_viewport_across_the_antimeridian():
+    wrapped = set(viewport_tiles([[-10, 170], [10, 190]], 3))
+    split = set(viewport_tiles([[-10, 170], [10, 180]], 3)) | set(viewport_tiles([[-10, -180], [10, -170]], 3))
+    assert wrapped == split
+    # Leaflet reports longitudes past ±180 once the map is panned around the world
+    assert set(viewport_tiles([[-10, 530], [10, 550]], 3)) == split
+
+
+def test_small_viewport_is_unchanged():
+    bounds = [[40.7, -74.05], [40.8, -73.9]]
+    (south, west), (north, east) = bounds
+    polygon = h3.LatLngPoly([(south, west), (north, west), (north, east), (south, east)])
+    expected = {h3.str_to_int(cell) for cell in h3.h3shape_to_cells_experimental(polygon, 7, contain="overlap")}
+    assert set(viewport_tiles(bounds, 7)) == expected
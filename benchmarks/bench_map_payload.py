@@ -0,0 +1,122 @@
+"""Benchmark the vectorized hexagon payload builder against the original per-row loop.
+
+Usage (from the repository root):
+    python benchmarks/bench_map_payload.py --sizes 10000 100000 1000000
+
+The original loop is slow at large sizes; pass --legacy-max to skip it above a size.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import h3
+import numpy as np
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+from app import build_hexagon_payload, create_log_color_scale  # noqa: E402
+
+
+def style_function(count, septiles):
+    fill_color = '#FFFFFF'  # default white
+    
+    if count >= septiles[6]:
+        fill_color = '#800026'      # dark red
+    elif count >= septiles[5]:
+        fill_color = '#BD0026'      # red
+    elif count >= septiles[4]:
+        fill_color = '#E31A1C'      # light red
+    elif count >= septiles[3]:
+        fill_color = '#FC4E2A'      # orange-red
+    elif count >= septiles[2]:
+        fill_color = '#FD8D3C'      # orange
+    elif count >= septiles[1]:
+        fill_color = '#FEB24C'      # light orange
+    elif count >= septiles[0]:
+        fill_color = '#FED976'      # yellow
+    
+    return {
+        "fillColor": fill_color,
+        "weight": 1,
+        "opacity": 0.9,
+        "color": fill_color,
+        "fillOpacity": 0.7
+    }
+
+
+def legacy_payload(map_data):
+    """The per-row loop create_leaflet_map used before the vectorized builder."""
+    septiles = create_log_color_scale(map_data['count'])
+    hex_centers_lats = []
+    hex_centers_lngs = []
+    hex_boundaries_polygons = []
+    hex_boundaries_geojson = {"type": "FeatureCollection", "features": []}
+    dlPolygons = []
+    for i in range(len(map_data)):
+        hex_boundaries_polygon = [[coord[1], coord[0]] for coord in json.loads(map_data.iloc[i]['hex_boundary'])['coordinates'][0]]
+        hex_boundaries_polygons.append(hex_boundaries_polygon)
+        hex_boundary_element = {'type': 'Feature'}
+        hex_boundary_element['geometry'] = json.loads(map_data.iloc[i]['hex_boundary'])
+        hex_centers_lats.append(json.loads(map_data.iloc[i]['hex_boundary'])['coordinates'][0][0][1])
+        hex_centers_lngs.append(json.loads(map_data.iloc[i]['hex_boundary'])['coordinates'][0][0][0])
+        hex_boundary_element['properties'] = {
+            'count': map_data.iloc[i]['count'].item(),
+            'color': style_function(map_data.iloc[i]['count'].item(), septiles)
+        }
+        hex_boundaries_geojson['features'].append(hex_boundary_element)
+        style = style_function(map_data.iloc[i]['count'].item(), septiles)
+        dlPolygons.append({
+            "positions": hex_boundaries_polygon,
+            "fillColor": style['fillColor'],
+            "color": style['color'],
+            "weight": style['weight'],
+            "opacity": style['opacity'],
+            "fillOpacity": style['fillOpacity']
+        })
+    return dlPolygons
+
+
+def make_cells(n, resolution=11):
+    """Return n distinct H3 cells around midtown Manhattan as GeoJSON boundary strings with random counts."""
+    origin = h3.latlng_to_cell(40.7549, -73.9840, resolution)
+    k = 1
+    while 3 * k * (k + 1) + 1 < n:
+        k += 1
+    cells = list(h3.grid_disk(origin, k))[:n]
+    boundaries = []
+    for cell in cells:
+        ring = [[lng, lat] for lat, lng in h3.cell_to_boundary(cell)]
+        ring.append(ring[0])
+        boundaries.append(json.dumps({"type": "Polygon", "coordinates": [ring]}))
+    counts = np.random.default_rng(0).lognormal(3, 2, n).astype(np.int64) + 1
+    cell_ids = np.array([h3.str_to_int(cell) for cell in cells], dtype=np.int64)
+    return pa.table({"h3_cell_id": cell_ids, "hex_boundary": boundaries, "count": counts})
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--legacy-max", type=int, default=100_000)
+    args = parser.parse_args()
+
+    print(f"{'cells':>10} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>8}")
+    for n in args.sizes:
+        table = make_cells(n)
+        vectorized = timed(build_hexagon_payload, table)
+        if n <= args.legacy_max:
+            legacy = timed(legacy_payload, table.to_pandas())
+            print(f"{n:>10} {legacy:>12.2f} {vectorized:>15.2f} {legacy / vectorized:>7.1f}x")
+        else:
+            print(f"{n:>10} {'skipped':>12} {vectorized:>15.2f} {'':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Benchmark the ways hexagon payloads can travel from the server to the browser.
+
+Compares, for the same cells:
+    polygons  one dl.Polygon component per cell (MAP_RENDER_MODE=polygons)
+    geojson   one GeoJSON FeatureCollection with server-side boundaries
+    json      cell IDs as hex strings plus counts (BOUNDARY_MODE=client)
+    binary    base64 uint32 cell halves and float32 counts
+              (BOUNDARY_MODE=client, HEX_CELL_TRANSPORT=binary)
+
+Encode is the server time to build and serialize the payload as Dash does,
+bytes is the response body size and decode is the time to turn it back into
+arrays (json.loads or base64 + np.frombuffer), a stand-in for the browser's
+JSON.parse / atob. Boundaries for the client modes are drawn by h3-js in the
+browser and are not timed here.
+
+Usage (from the repository root):
+    python benchmarks/bench_transport.py --sizes 10000 100000
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+import h3
+import numpy as np
+import pyarrow as pa
+from dash._utils import to_json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+import app  # noqa: E402
+
+
+def make_cells(n, resolution=11):
+    """Return n distinct H3 cells around midtown Manhattan with random counts."""
+    origin = h3.latlng_to_cell(40.7549, -73.9840, resolution)
+    k = 1
+    while 3 * k * (k + 1) + 1 < n:
+        k += 1
+    cells = np.array([h3.str_to_int(cell) for cell in list(h3.grid_disk(origin, k))[:n]], dtype=np.int64)
+    counts = np.random.default_rng(0).lognormal(3, 2, n).astype(np.int64) + 1
+    return pa.table({"h3_cell_id": cells, "count": counts})
+
+
+def encode_polygons(table):
+    return to_json(app.create_polygon_components(app.build_hexagon_payload(table)))
+
+
+def encode_geojson(table):
+    data, hideout = app.hexagon_layer_props(app.build_hexagon_payload(table))
+    return to_json({"data": data, "hideout": hideout})
+
+
+def encode_cells(transport):
+    def encode(table):
+        app.HEX_CELL_TRANSPORT = transport
+        return to_json(app.hex_cells_for_browser(app.build_hexagon_payload(table, with_rings=False)))
+    return encode
+
+
+def decode_json(body):
+    json.loads(body)
+
+
+def decode_binary(body):
+    message = json.loads(body)
+    np.frombuffer(base64.b64decode(message["cells"]), dtype="<u4")
+    np.frombuffer(base64.b64decode(message["counts"]), dtype="<f4")
+
+
+TRANSPORTS = [
+    ("polygons", encode_polygons, decode_json),
+    ("geojson", encode_geojson, decode_json),
+    ("json", encode_cells("json"), decode_json),
+    ("binary", encode_cells("binary"), decode_binary),
+]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    print(f"{'cells':>10} {'transport':>10} {'encode (s)':>11} {'MB':>8} {'decode (s)':>11}")
+    for n in args.sizes:
+        table = make_cells(n)
+        for name, encode, decode in TRANSPORTS:
+            # Start every transport with cold boundary lookups
+            app.cell_boundary.cache_clear()
+            encode_time, body = timed(encode, table)
+            decode_time, _ = timed(decode, body)
+            print(f"{n:>10} {name:>10} {encode_time:>11.2f} {len(body) / 1e6:>8.2f} {decode_time:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # NB03: Build H3 Aggregate Pyramid
+# MAGIC
+# MAGIC > Materializes `(cell, count)` aggregates of one or more H3 columns for every resolution from `min_resolution` up to the column's native resolution. The app routes a map refresh to the matching pyramid level instead of scanning the raw table, so low-zoom refreshes read a small table instead of every row.
+# MAGIC
+# MAGIC __Notes:__
+# MAGIC
+# MAGIC * Friendly for use in Serverless compute on Databricks; runs as the `h3_aggregate_pyramid` job in the bundle
+# MAGIC * The pyramid is written next to the source table as `<table>_h3_pyramid`, clustered by `(source_column, resolution, h3_cell_id)`
+# MAGIC * Each column's built levels and the source table version they reflect are recorded as table properties (`h3_pyramid.levels.<column>`, `h3_pyramid.source_version.<column>`). The app only uses a level when its recorded version matches the current source version.
+# MAGIC * Refreshes are incremental when the source table has [Change Data Feed](https://docs.databricks.com/aws/en/delta/delta-change-data-feed) enabled; otherwise each column is rebuilt with a single scan
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## [1] Setup
+
+# COMMAND ----------
+
+dbutils.widgets.text("catalog", "mjohns")
+dbutils.widgets.text("schema", "liquid_nyc_h3_trip")
+dbutils.widgets.text("table", "h3_taxi_trips")
+dbutils.widgets.text("columns", "pickup_cell_12,dropoff_cell_12")
+dbutils.widgets.text("min_resolution", "5")
+dbutils.widgets.dropdown("full_refresh", "false", ["false", "true"])
+
+# COMMAND ----------
+
+catalog_name = dbutils.widgets.get("catalog")
+schema_name = dbutils.widgets.get("schema")
+table_name = dbutils.widgets.get("table")
+columns = [c.strip() for c in dbutils.widgets.get("columns").split(",") if c.strip()]
+min_resolution = int(dbutils.widgets.get("min_resolution"))
+full_refresh = dbutils.widgets.get("full_refresh") == "true"
+
+source_table = f"{catalog_name}.{schema_name}.{table_name}"
+pyramid_table = f"{source_table}_h3_pyramid"
+
+spark.sql(f"""
+  CREATE TABLE IF NOT EXISTS {pyramid_table} (
+    source_column STRING,
+    resolution INT,
+    h3_cell_id BIGINT,
+    count BIGINT
+  ) CLUSTER BY (source_column, resolution, h3_cell_id)
+""")
+
+source_version = spark.sql(f"DESCRIBE HISTORY {source_table} LIMIT 1").first().version
+source_properties = {r.key: r.value for r in spark.sql(f"SHOW TBLPROPERTIES {source_table}").collect()}
+cdf_enabled = source_properties.get("delta.enableChangeDataFeed", "false").lower() == "true"
+pyramid_properties = {r.key: r.value for r in spark.sql(f"SHOW TBLPROPERTIES {pyramid_table}").collect()}
+source_schema = spark.table(source_table).schema
+
+print(f"source: {source_table} @ version {source_version}, change data feed: {cdf_enabled}")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## [2] Build Or Refresh Each Column
+# MAGIC
+# MAGIC > Each build aggregates the source column once at its native resolution, then rolls the counts up to every coarser level with `h3_toparent`. That way every level comes from a single scan.
+
+# COMMAND ----------
+
+def rollup_sql(column, cells_sql, native_resolution):
+    """All pyramid levels for column from a (cell, c) relation at the native resolution."""
+    return f"""
+      SELECT '{column}' as source_column,
+             resolution,
+             h3_toparent(cell, resolution) as h3_cell_id,
+             sum(c) as count
+      FROM ({cells_sql})
+      LATERAL VIEW explode(sequence({min_resolution}, {native_resolution})) levels AS resolution
+      GROUP BY ALL
+    """
+
+def full_rebuild(column, cell_expr, native_resolution):
+    spark.sql(f"""
+      INSERT INTO {pyramid_table} REPLACE WHERE source_column = '{column}'
+      {rollup_sql(column, f"SELECT {cell_expr} as cell, count(*) as c FROM {source_table} VERSION AS OF {source_version} WHERE {column} IS NOT NULL GROUP BY ALL", native_resolution)}
+    """)
+
+def incremental_refresh(column, cell_expr, native_resolution, from_version):
+    changes = f"""
+      SELECT {cell_expr} as cell,
+             sum(CASE WHEN _change_type IN ('insert', 'update_postimage') THEN 1 ELSE -1 END) as c
+      FROM table_changes('{source_table}', {from_version}, {source_version})
+      WHERE {column} IS NOT NULL
+      GROUP BY ALL
+    """
+    spark.sql(f"""
+      MERGE INTO {pyramid_table} p
+      USING ({rollup_sql(column, changes, native_resolution)}) d
+      ON p.source_column = d.source_column AND p.resolution = d.resolution AND p.h3_cell_id = d.h3_cell_id
+      WHEN MATCHED THEN UPDATE SET p.count = p.count + d.count
+      WHEN NOT MATCHED THEN INSERT *
+    """)
+    spark.sql(f"DELETE FROM {pyramid_table} WHERE source_column = '{column}' AND count <= 0")
+
+for column in columns:
+    is_string = source_schema[column].dataType.simpleString() == "string"
+    cell_expr = f"h3_stringtoh3({column})" if is_string else column
+    native_resolution = spark.sql(
+        f"SELECT h3_resolution({column}) as r FROM {source_table} WHERE {column} IS NOT NULL LIMIT 1"
+    ).first().r
+    levels = list(range(min_resolution, native_resolution + 1))
+    built_version = pyramid_properties.get(f"h3_pyramid.source_version.{column}")
+    built_levels = pyramid_properties.get(f"h3_pyramid.levels.{column}")
+    same_levels = built_levels == ",".join(str(r) for r in levels)
+
+    if not full_refresh and same_levels and built_version is not None and int(built_version) == source_version:
+        print(f"{column}: up to date at version {source_version}")
+        continue
+    if not full_refresh and same_levels and built_version is not None and cdf_enabled:
+        try:
+            incremental_refresh(column, cell_expr, native_resolution, int(built_version) + 1)
+            print(f"{column}: applied changes {int(built_version) + 1}-{source_version}")
+        except Exception as e:
+            # e.g. the change feed for those versions was vacuumed
+            print(f"{column}: incremental refresh failed ({e}), rebuilding")
+            full_rebuild(column, cell_expr, native_resolution)
+    else:
+        full_rebuild(column, cell_expr, native_resolution)
+        print(f"{column}: rebuilt resolutions {levels[0]}-{levels[-1]}")
+
+    spark.sql(f"""
+      ALTER TABLE {pyramid_table} SET TBLPROPERTIES (
+        'h3_pyramid.levels.{column}' = '{",".join(str(r) for r in levels)}',
+        'h3_pyramid.source_version.{column}' = '{source_version}'
+      )
+    """)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## [3] Inspect The Pyramid
+
+# COMMAND ----------
+
+display(spark.sql(f"""
+  SELECT source_column, resolution, format_number(count(1), 0) as cells, format_number(sum(count), 0) as rows
+  FROM {pyramid_table}
+  GROUP BY ALL
+  ORDER BY source_column, resolution
+"""))
@@ -0,0 +1,169 @@
+"""Local stand-in for the SQL Statement Execution API, for running the app without a warehouse.
+
+Implements the subset of /api/2.0/sql/statements the app uses with
+SQL_EXECUTION_MODE=statement_api: asynchronous submit, polling, cancel and
+Arrow result chunks behind external links. Statements are not executed; each
+query the app sends is recognized by its shape and answered with synthetic
+data for one table whose H3 aggregates cluster around midtown Manhattan,
+with a second H3 column for compare mode.
+--delay and --chunk-delay make the warehouse slow enough to exercise
+timeouts, cancellation and parallel chunk downloads.
+
+Usage (from the repository root):
+    python tools/standin_warehouse.py --port 8090 --delay 2 --chunks 4
+    cd app && SQL_EXECUTION_MODE=statement_api \\
+        SQL_STATEMENT_API_URL=http://localhost:8090/api/2.0/sql/statements \\
+        DATABRICKS_HOST=localhost DATABRICKS_TOKEN=local DATABRICKS_WAREHOUSE_ID=local \\
+        DEFAULT_CATALOG=demo DEFAULT_SCHEMA=nyc DEFAULT_TABLE=trips DEFAULT_COLUMN=cell_12 \\
+        python app.py
+"""
+import argparse
+import re
+import threading
+import time
+import uuid
+
+import flask
+import h3
+import numpy as np
+import pyarrow as pa
+
+CATALOG, SCHEMA, TABLE = "demo", "nyc", "trips"
+COLUMN, COLUMN_RESOLUTION = "cell_12", 12
+COMPARE_COLUMN = "dropoff_cell_12"
+CENTER = (40.7549, -73.9840)
+
+server = flask.Flask(__name__)
+statements = {}
+statements_lock = threading.Lock()
+options = argparse.Namespace(delay=1.0, chunk_delay=0.0, chunks=4, cells=20000, rows=50_000_000)
+
+
+def aggregate_result(query):
+    """Synthetic (h3_cell_id, count) rows at the resolution the query groups by.
+
+    Compare queries get (h3_cell_id, count_a, count_b) rows instead.
+    """
+    match = re.search(r"h3_toparent\(\w+, (\d+)\)", query)
+    resolution = int(match.group(1)) if match else COLUMN_RESOLUTION
+    k = 1
+    while 3 * k * (k + 1) + 1 < options.cells:
+        k += 1
+    cells = list(h3.grid_disk(h3.latlng_to_cell(*CENTER, resolution), k))[:options.cells]
+    rng = np.random.default_rng(resolution)
+    cell_ids = np.array([h3.str_to_int(c) for c in cells], dtype=np.int64)
+    counts = rng.lognormal(3, 2, len(cells)).astype(np.int64) + 1
+    if "stack(2" in query:
+        return pa.table({"h3_cell_id": cell_ids, "count_a": counts,
+                         "count_b": rng.lognormal(3, 2, len(cells)).astype(np.int64)})
+    return pa.table({"h3_cell_id": cell_ids, "count": counts})
+
+
+def answer(query):
+    """Result table for a statement, or an error message for statements the stand-in doesn't know."""
+    if "DESCRIBE HISTORY" in query:
+        return pa.table({"version": pa.array([1], pa.int64())})
+    if "DESCRIBE TABLE" in query:
+        return pa.table({"col_name": [COLUMN, COMPARE_COLUMN], "data_type": ["bigint", "bigint"],
+                         "comment": pa.array([None, None], pa.string())})
+    if "row_filters" in query:
+        return pa.table({"policies": pa.array([0], pa.int64())})
+    if "information_schema.columns" in query:
+        return pa.table({"table_catalog": [CATALOG] * 2, "table_schema": [SCHEMA] * 2, "table_name": [TABLE] * 2,
+                         "column_name": [COLUMN, COMPARE_COLUMN]})
+    if "h3_isvalid" in query:
+        probed = re.findall(r" as r(\d+)", query)
+        return pa.table({name: value for i in probed
+                         for name, value in ((f"r{i}", pa.array([COLUMN_RESOLUTION], pa.int32())), (f"v{i}", [True]))})
+    if "bool_and" in query:
+        return pa.table({"r0": pa.array([COLUMN_RESOLUTION], pa.int32()), "m0": [True]})
+    if "as row_count" in query:
+        return pa.table({"row_count": pa.array([options.rows], pa.int64()), "resolution": pa.array([COLUMN_RESOLUTION], pa.int32())})
+    if "as h3_cell_id" in query or "stack(2" in query:
+        return aggregate_result(query)
+    return "[TABLE_OR_VIEW_NOT_FOUND] The stand-in warehouse only answers the app's own queries"
+
+
+def statement_response(statement):
+    response = {"statement_id": statement["id"], "status": {"state": statement["state"]}}
+    if statement["state"] == "FAILED":
+        response["status"]["error"] = {"message": statement["error"]}
+    if statement["state"] == "SUCCEEDED":
+        columns = [{"name": f.name, "type_name": str(f.type).upper().replace("INT64", "BIGINT").replace("INT32", "INT")}
+                   for f in statement["result"].schema]
+        response["manifest"] = {"total_chunk_count": len(statement["chunks"]), "schema": {"columns": columns}}
+        response["result"] = {"external_links": [chunk_link(statement, 0)] if statement["chunks"] else []}
+    return response
+
+
+def chunk_link(statement, index):
+    return {"chunk_index": index, "external_link": f"{flask.request.host_url}chunks/{statement['id']}/{index}"}
+
+
+def get_statement(statement_id):
+    with statements_lock:
+        statement = statements.get(statement_id)
+    if statement is None:
+        flask.abort(404)
+    if statement["state"] == "RUNNING" and time.time() >= statement["ready_at"]:
+        result = answer(statement["query"])
+        if isinstance(result, str):
+            statement.update(state="FAILED", error=result)
+        else:
+            rows_per_chunk = max(-(-result.num_rows // options.chunks), 1)
+            statement.update(state="SUCCEEDED", result=result,
+                             chunks=[result.slice(i, rows_per_chunk) for i in range(0, result.num_rows, rows_per_chunk)])
+    return statement
+
+
+@server.post("/api/2.0/sql/statements")
+def submit():
+    body = flask.request.get_json()
+    statement = {"id": uuid.uuid4().hex, "query": body["statement"], "state": "RUNNING", "ready_at": time.time() + options.delay}
+    with statements_lock:
+        statements[statement["id"]] = statement
+    return flask.jsonify(statement_response(get_statement(statement["id"])))
+
+
+@server.get("/api/2.0/sql/statements/<statement_id>")
+def status(statement_id):
+    return flask.jsonify(statement_response(get_statement(statement_id)))
+
+
+@server.post("/api/2.0/sql/statements/<statement_id>/cancel")
+def cancel(statement_id):
+    statement = get_statement(statement_id)
+    if statement["state"] == "RUNNING":
+        statement["state"] = "CANCELED"
+    return flask.jsonify({})
+
+
+@server.get("/api/2.0/sql/statements/<statement_id>/result/chunks/<int:index>")
+def chunk_links(statement_id, index):
+    return flask.jsonify({"external_links": [chunk_link(get_statement(statement_id), index)]})
+
+
+@server.get("/chunks/<statement_id>/<int:index>")
+def chunk(statement_id, index):
+    time.sleep(options.chunk_delay)
+    data = get_statement(statement_id)["chunks"][index]
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, data.schema) as writer:
+        writer.write_table(data)
+    return flask.Response(sink.getvalue().to_pybytes(), mimetype="application/vnd.apache.arrow.stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--delay", type=float, default=1.0, help="seconds each statement runs")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds to serve each result chunk")
+    parser.add_argument("--chunks", type=int, default=4, help="result chunks per statement")
+    parser.add_argument("--cells", type=int, default=20000, help="cells per aggregation result")
+    parser.add_argument("--rows", type=int, default=50_000_000, help="reported table row count")
+    parser.parse_args(namespace=options)
+    server.run(port=options.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()